@@ -7,7 +7,7 @@ START=`date "+%Y%m%d %H%M%S"`
 echo "Started: $START"
 
 # Download sample 100k file if missing
-if [ ! -f /data/input/data.tsv -a ! -f /data/input/data.tsv.gz ]; then
+if [ ! -f /data/input/data.tsv -a ! -f /data/input/data.tsv.gz -a ! -f /data/input/data.tsv.zst ]; then
     mkdir -p /data/input/
     curl -L -s https://github.com/OSMNames/OSMNames/releases/download/v2.0.4/planet-latest-100k_geonames.tsv.gz \
         -o /data/input/planet-v2.0.4-100k_geonames.tsv.gz
@@ -19,11 +19,59 @@ if [ ! -f /data/index/ind_name_prefix_0.spa -o "$1" = "force" ]; then
     mkdir -p /data/index/
     set +e
     echo "Reindex started: "`date "+%Y%m%d %H%M%S"`
+    DATA_FILE=/data/input/data.tsv
+    if [ -f /data/input/data.tsv.gz ]; then
+        DATA_FILE=/data/input/data.tsv.gz
+    elif [ -f /data/input/data.tsv.zst ]; then
+        DATA_FILE=/data/input/data.tsv.zst
+    fi
+    # Decompress in parallel and split the rows of the local indexes, read by sphinx.conf sources
+    # (the sources decompress the data for each index themselves, if the ingest fails)
+    INGEST_DIR=${INGEST_DIR:-/data/ingest}
+    export INGEST_DIR
+    rm -rf $INGEST_DIR
+    STAGE_START=$SECONDS
+    # The areas and prefixes indexes read the ingested rows too, if they are all rows of the data (one node)
+    ROWS_SOURCE=$DATA_FILE
+    if python /usr/local/src/websearch/ingest.py $DATA_FILE $INGEST_DIR; then
+        if [ "${SPHINX_NODE_COUNT:-1}" = "1" ]; then
+            ROWS_SOURCE=$INGEST_DIR
+        fi
+    else
+        echo "Ingest failed"
+    fi
+    echo "Stage ingest: $((SECONDS - STAGE_START)) seconds"
+    # ind_names_prefix was a byte-identical copy of ind_name_prefix, now a distributed alias of it
+    rm -f /data/index/ind_names_prefix_*
+    STAGE_START=$SECONDS
     /usr/bin/indexer -c /etc/sphinxsearch/sphinx.conf --rotate --all
+    rc=$?
+    echo "Stage indexer: $((SECONDS - STAGE_START)) seconds"
     echo "Reindex finished: "`date "+%Y%m%d %H%M%S"`
-    rc=$? && [ $rc -eq 1 ] && exit $rc
+    if [ $rc -eq 1 ]; then
+        rm -rf $INGEST_DIR
+        exit $rc
+    fi
     set -e
+    # Containing areas index (bounding boxes of boundary and place rows)
+    STAGE_START=$SECONDS
+    python /usr/local/src/websearch/areas.py $ROWS_SOURCE /data/index/areas.bin \
+        || echo "Areas index failed"
+    echo "Stage areas: $((SECONDS - STAGE_START)) seconds"
+    # Top places of short prefixes for autocomplete, per country with PREFIXES_COUNTRIES=1
+    STAGE_START=$SECONDS
+    PREFIXES_ARGS=""
+    if [ "$PREFIXES_COUNTRIES" = "1" ]; then
+        PREFIXES_ARGS="--countries"
+    fi
+    python /usr/local/src/websearch/prefixes.py $ROWS_SOURCE /data/index/prefixes.bin $PREFIXES_ARGS \
+        || echo "Prefixes index failed"
+    echo "Stage prefixes: $((SECONDS - STAGE_START)) seconds"
+    rm -rf $INGEST_DIR
     touch /tmp/osmnames-sphinxsearch-data.timestamp
+    # Index statistics and recommended settings for the host, next to the data timestamp
+    python /usr/local/src/websearch/index_stats.py /data/index /tmp/osmnames-sphinxsearch-index-stats.json \
+        || echo "Index statistics failed"
 fi
 
 # Start sphinx job in supervisor
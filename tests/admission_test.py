@@ -0,0 +1,136 @@
+"""
+Unit tests for the admission control of SphinxQL work (web/admission.py)
+
+The semaphores are shared by forked processes through a temporary directory,
+no uwsgi or sphinx is needed: run from within the docker container,
+or from the repository.
+"""
+from os import _exit, close, fork, path, pipe, read, waitpid, write
+from time import sleep, time
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'web'))
+
+import admission
+from admission import AdmissionControl, SharedSemaphore
+
+IPC_RMID = 0
+
+times = {}
+times['start'] = time()
+
+directory = tempfile.mkdtemp()
+semaphores = []
+
+
+def semaphore(value):
+    sem = SharedSemaphore(directory, value)
+    semaphores.append(sem)
+    return sem
+
+
+def holder(sem, timeout=0):
+    """Fork a process, which takes a permit (waiting at most timeout) and holds it until told to exit."""
+    ready_read, ready_write = pipe()
+    exit_read, exit_write = pipe()
+    pid = fork()
+    if pid == 0:
+        taken = sem.acquire(timeout)
+        write(ready_write, 'y' if taken else 'n')
+        read(exit_read, 1)
+        _exit(0)
+    close(ready_write)
+    return pid, ready_read, exit_write
+
+
+def finish(process):
+    pid, ready_read, exit_write = process
+    write(exit_write, 'x')
+    waitpid(pid, 0)
+
+
+def wait_for(condition):
+    until = time() + 2.0
+    while not condition() and time() < until:
+        sleep(0.001)
+    return condition()
+
+
+try:
+    #tests for the concurrency limit across processes
+
+    control = AdmissionControl(directory, max_concurrent=2, max_queue=0, queue_timeout=0.5,
+                               semaphore=semaphore(2))
+    first = holder(control.semaphore)
+    second = holder(control.semaphore)
+    assert(read(first[1], 1)=='y' and read(second[1], 1)=='y')
+    assert(control.acquire() is None)
+    print("test 1a passed")
+
+    # the permits of a finished (or killed) process are returned by the kernel
+    finish(first)
+    assert(control.acquire()==True)
+    control.release(True)
+    finish(second)
+    assert(control.acquire()==True and control.acquire()==True)
+    control.release(True)
+    control.release(True)
+    print("test 1b passed")
+
+    #tests for the queue bound and the shed path
+
+    control = AdmissionControl(directory, max_concurrent=1, max_queue=1, queue_timeout=0.2,
+                               semaphore=semaphore(1))
+    running = holder(control.semaphore)
+    assert(read(running[1], 1)=='y')
+    queued = holder(control.semaphore, timeout=5.0)
+    assert(wait_for(lambda: control.semaphore.waiting()==1))
+    # the queue is full, shed without waiting
+    start = time()
+    assert(control.acquire() is None)
+    assert(time() - start < 0.1)
+    print("test 2a passed")
+
+    # the queued request gets the permit when it is released
+    finish(running)
+    assert(read(queued[1], 1)=='y')
+    finish(queued)
+    print("test 2b passed")
+
+    # queue timeout, the deadline shortens the wait
+    running = holder(control.semaphore)
+    assert(read(running[1], 1)=='y')
+    queue = []
+    start = time()
+    assert(control.acquire(on_queue=queue.append) is None)
+    assert(0.15 < time() - start < 1.0)
+    assert(queue==[1, -1])
+    start = time()
+    assert(control.acquire(deadline=time() + 0.05) is None)
+    assert(time() - start < 0.15)
+    assert(control.acquire(deadline=time() - 1) is None)
+    finish(running)
+    print("test 2c passed")
+
+    #test for another configuration, it does not resize the live semaphore
+
+    live = semaphore(3)
+    other = semaphore(5)
+    assert(live.semid!=other.semid)
+    assert([live.acquire(0) for i in range(4)]==[True, True, True, False])
+    assert(semaphore(3).semid==live.semid)
+    assert(live.acquire(0)==False)
+    for i in range(3):
+        live.release()
+    print("test 3 passed")
+finally:
+    for sem in semaphores:
+        admission._libc.semctl(sem.semid, 0, IPC_RMID)
+    shutil.rmtree(directory)
+
+times['end'] = time()
+times['duration'] = times['end'] - times['start']
+
+print "tests completed in ", times['duration']
@@ -0,0 +1,120 @@
+"""
+Unit tests for the containing areas index (web/areas.py)
+
+The index is built from a generated TSV file, no sphinx is needed:
+run from within the docker container, or from the repository.
+"""
+from os import path, remove
+from time import time
+import random
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'web'))
+
+import areas
+from ingest import COLUMNS
+
+times = {}
+times['start'] = time()
+
+
+def row(name, cl, rank, west, south, east, north):
+    values = dict((col, '') for col in COLUMNS)
+    values.update({'name_en': name, 'class': cl, 'type': 'administrative', 'place_rank': str(rank),
+                   'lon': str((west + east) / 2.0), 'lat': str((south + north) / 2.0),
+                   'west': str(west), 'south': str(south), 'east': str(east), 'north': str(north)})
+    return '\t'.join(values[col] for col in COLUMNS)
+
+
+def build_index(rows):
+    data = tempfile.NamedTemporaryFile(suffix='.tsv', delete=False)
+    data.write('\t'.join(COLUMNS) + '\n')
+    for r in rows:
+        data.write(r + '\n')
+    data.close()
+    filename = data.name + '.bin'
+    try:
+        areas.build(data.name, filename)
+        return areas.AreaIndex(filename)
+    finally:
+        remove(data.name)
+        if path.isfile(filename):
+            remove(filename)
+
+
+# ids are line numbers, the header is line 1
+index = build_index([
+    row('country', 'boundary', 4, 0.0, 0.0, 20.0, 20.0),          # id 2
+    row('state', 'boundary', 8, 5.0, 5.0, 10.0, 10.0),             # id 3
+    row('city', 'place', 16, 6.0, 6.0, 7.0, 7.0),                  # id 4
+    row('street', 'highway', 26, 6.0, 6.0, 7.0, 7.0),              # id 5
+    row('point', 'place', 20, 6.5, 6.5, 6.5, 6.5),                 # id 6
+    row('fiji', 'boundary', 4, 170.0, -20.0, -170.0, -10.0),      # id 7
+    row('islands', 'place', 16, 179.0, -16.0, -179.0, -15.0),     # id 8
+])
+
+#tests for point in area
+
+assert([area[0] for area in index.contains(6.5, 6.5)]==[4, 3, 2])
+assert(index.contains(6.5, 6.5)[0]==(4, 'place', 16))
+print("test 1a passed")
+
+assert([area[0] for area in index.contains(15.0, 15.0)]==[2])
+assert(index.contains(25.0, 15.0)==[])
+assert(index.contains(15.0, -5.0)==[])
+print("test 1b passed")
+
+assert([area[0] for area in index.contains(6.5, 6.5, ['boundary'])]==[3, 2])
+assert([area[0] for area in index.contains(6.5, 6.5, ['place'])]==[4])
+assert(index.contains(6.5, 6.5, ['highway'])==[])
+print("test 1c passed")
+
+#tests for the areas spanning the 180 meridian
+
+assert([area[0] for area in index.contains(175.0, -15.0)]==[7])
+assert([area[0] for area in index.contains(-175.0, -15.0)]==[7])
+assert([area[0] for area in index.contains(179.5, -15.5)]==[8, 7])
+assert([area[0] for area in index.contains(-179.5, -15.5)]==[8, 7])
+assert([area[0] for area in index.contains(180.0, -15.5)]==[8, 7])
+assert([area[0] for area in index.contains(-180.0, -15.5)]==[8, 7])
+print("test 2a passed")
+
+assert(index.contains(0.0, -15.0)==[])
+assert(index.contains(165.0, -15.0)==[])
+assert(index.contains(-165.0, -15.0)==[])
+assert(index.contains(175.0, -25.0)==[])
+print("test 2b passed")
+
+#test for the R-tree of more levels against the full scan
+
+random.seed(1)
+boxes = []
+for i in range(2000):
+    west = random.randint(-180, 179)
+    south = random.randint(-90, 89)
+    east = west + random.randint(1, 30)
+    if east > 180:
+        east -= 360
+    north = min(90, south + random.randint(1, 30))
+    boxes.append((west, south, east, north))
+index = build_index([row('area', 'boundary', i % 30, *box) for i, box in enumerate(boxes)])
+assert(len(index.levels)>2)
+for i in range(500):
+    lon = random.randint(-180, 179) + 0.5
+    lat = random.randint(-90, 89) + 0.5
+    expected = set()
+    for j, (west, south, east, north) in enumerate(boxes):
+        inside_lon = west <= lon <= east if west < east else lon >= west or lon <= east
+        if inside_lon and south <= lat <= north:
+            expected.add(j + 2)
+    found = index.contains(lon, lat)
+    assert(set(area[0] for area in found)==expected)
+    assert(len(found)==len(expected))
+    assert([area[2] for area in found]==sorted([area[2] for area in found], reverse=True))
+print("test 3 passed")
+
+times['end'] = time()
+times['duration'] = times['end'] - times['start']
+
+print "tests completed in ", times['duration']
@@ -0,0 +1,135 @@
+"""
+Unit tests for the index statistics report (web/index_stats.py)
+
+The reindex log and the index files are generated, no sphinx is needed:
+run from within the docker container, or from the repository.
+"""
+from os import path
+from time import time
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'web'))
+
+import index_stats
+
+times = {}
+times['start'] = time()
+
+directory = tempfile.mkdtemp()
+
+# Two reindex runs, as appended by sphinx-reindex.sh and the indexer output
+LOG = """Started: 20260101 010000
+Reindex started: 20260101 010001
+Stage ingest: 9 seconds
+indexing index 'ind_name_exact_0'...
+total 100 docs, 1000 bytes
+total 9.000 sec, 111 bytes/sec, 11.11 docs/sec
+Stage indexer: 99 seconds
+========
+Started: 20260102 010000
+Reindex started: 20260102 010001
+Stage ingest: 12 seconds
+Sphinx 2.2.11-id64-release (95ae9a6)
+using config file '/etc/sphinxsearch/sphinx.conf'...
+indexing index 'ind_name_exact_0'...
+collected 50000 docs, 2.5 MB
+sorted 0.4 Mhits, 100.0% done
+total 50000 docs, 2500000 bytes
+total 2.512 sec, 995222 bytes/sec, 19904.45 docs/sec
+indexing index 'ind_name_exact_1'...
+collected 49999 docs, 2.4 MB
+total 49999 docs, 2400000 bytes
+total 2.250 sec, 1066666 bytes/sec, 22221.77 docs/sec
+indexing index 'ind_name_prefix_0'...
+WARNING: index 'ind_name_prefix_0': no documents
+total 0 docs, 0 bytes
+total 0.011 sec, 0 bytes/sec, 0.00 docs/sec
+skipping non-plain index 'ind_name_exact'...
+Stage indexer: 35 seconds
+Reindex finished: 20260102 010040
+Stage areas: 3 seconds
+Stage prefixes: 4.5 seconds
+"""
+
+
+def write(filename, data):
+    with open(path.join(directory, filename), 'w') as f:
+        f.write(data)
+
+
+try:
+    log_filename = path.join(directory, 'sphinx-reindex.log')
+    write('sphinx-reindex.log', LOG)
+
+    #tests for the parsing of the reindex log
+
+    lines = index_stats.last_reindex_log(log_filename)
+    assert(lines[0]=='Reindex started: 20260102 010001')
+    assert(lines[-1]=='Stage prefixes: 4.5 seconds')
+    assert(index_stats.last_reindex_log(path.join(directory, 'missing.log'))==[])
+    write('empty.log', 'Started: 20260102 010000\n')
+    assert(index_stats.last_reindex_log(path.join(directory, 'empty.log'))==[])
+    print("test 1a passed")
+
+    indexes = index_stats.parse_indexer_log(lines)
+    assert(sorted(indexes)==['ind_name_exact_0', 'ind_name_exact_1', 'ind_name_prefix_0'])
+    assert(indexes['ind_name_exact_0']=={'documents': 50000, 'source_bytes': 2500000, 'seconds': 2.512})
+    assert(indexes['ind_name_exact_1']['documents']==49999)
+    assert(indexes['ind_name_prefix_0']=={'documents': 0, 'source_bytes': 0, 'seconds': 0.011})
+    print("test 1b passed")
+
+    # the stage lines after the indexer do not belong to its last index
+    stages = index_stats.parse_stages(lines)
+    assert(stages=={'ingest': 12.0, 'indexer': 35.0, 'areas': 3.0, 'prefixes': 4.5})
+    print("test 1c passed")
+
+    #tests for the index files and the collected statistics
+
+    write('ind_name_exact_0.spa', 'a' * 100)
+    write('ind_name_exact_0.spd', 'd' * 1000)
+    write('ind_name_exact_0.sps', 's' * 10)
+    write('ind_name_exact_1.spa', 'a' * 50)
+    write('ind_name_exact_1.new.spa', 'a' * 70)
+    write('ind_name_exact_1.spi', 'i' * 5)
+    write('ind_name_prefix_0.spi', 'i' * 7)
+    write('ind_name_exact.sph', 'distributed index has no files')
+    write('areas.bin', 'not sphinx')
+
+    files = index_stats.index_files(directory)
+    assert(sorted(files)==[('ind_name_exact', 0), ('ind_name_exact', 1), ('ind_name_prefix', 0)])
+    assert(files[('ind_name_exact', 0)]=={'spa': 100, 'spd': 1000, 'sps': 10})
+    # the files waiting for rotation are preferred
+    assert(files[('ind_name_exact', 1)]=={'spa': 70, 'spi': 5})
+    print("test 2a passed")
+
+    stats = index_stats.collect(directory, log_filename)
+    exact = stats['indexes']['ind_name_exact']
+    assert(exact['documents']==99999)
+    assert(exact['disk_bytes']==1185 and exact['attr_bytes']==180 and exact['memory_bytes']==185)
+    assert(exact['seconds']==2.512 + 2.250)
+    assert(exact['shards'][1]['documents']==49999)
+    assert(stats['indexes']['ind_name_prefix']['documents']==0)
+    assert(stats['totals']=={'disk_bytes': 1192, 'attr_bytes': 180, 'memory_bytes': 192})
+    assert(stats['stages']['indexer']==35.0)
+    print("test 2b passed")
+
+    #test for the recommendation
+
+    recommendation = index_stats.recommend(stats, 8 * 2 ** 30, 4)
+    assert(recommendation['SPHINX_MEM_LIMIT']=='2047M')
+    assert(recommendation['SPHINX_ONDISK_ATTRS']==0)
+    assert(recommendation['SPHINX_LOCAL_INDEX_THREADS']==1)
+    assert('SPHINX_NODE_COUNT' not in recommendation and recommendation['reasons']==[])
+    recommendation = index_stats.recommend(stats, 600, 4)
+    assert(recommendation['SPHINX_ONDISK_ATTRS']==1 and recommendation['SPHINX_NODE_COUNT']==3)
+    assert(len(recommendation['reasons'])==2)
+    print("test 3 passed")
+finally:
+    shutil.rmtree(directory)
+
+times['end'] = time()
+times['duration'] = times['end'] - times['start']
+
+print "tests completed in ", times['duration']
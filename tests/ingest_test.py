@@ -0,0 +1,155 @@
+"""
+Unit tests for the parallel ingest of the input data (web/ingest.py)
+
+The rows of ingest() are compared with the output of the tsvpipe commands
+generated by sphinx.conf (the gawk filter of the input data, or awk if gawk is
+not installed), no sphinx is needed: run from within the docker container,
+or from the repository.
+"""
+from os import environ, listdir, path
+from subprocess import PIPE, Popen
+from time import time
+import gzip
+import re
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'web'))
+
+import ingest
+from ingest import COLUMNS
+
+SPHINX_CONF = '/etc/sphinxsearch/sphinx.conf'
+if not path.isfile(SPHINX_CONF):
+    SPHINX_CONF = path.join(path.dirname(path.abspath(__file__)), '..', 'conf', 'sphinx', 'sphinx.conf')
+
+LOCAL_INDEX_THREADS = 3
+NODE_COUNT = 2
+NODE_ID = 1
+
+times = {}
+times['start'] = time()
+
+directory = tempfile.mkdtemp()
+
+
+def row(i, importance):
+    values = dict((col, '{}_{}'.format(col, i)) for col in COLUMNS)
+    values['importance'] = importance
+    return '\t'.join(values[col] for col in COLUMNS)
+
+
+def run(command):
+    process = Popen(command, shell=True, stdout=PIPE)
+    output = process.communicate()[0]
+    assert(process.returncode==0)
+    return output
+
+
+def tsvpipe_commands(data_filename, ingest_dir):
+    """Commands of the tsv and text sources of the local indexes generated by sphinx.conf."""
+    env = dict(environ, INGEST_DIR=ingest_dir, SPHINX_LOCAL_INDEX_THREADS=str(LOCAL_INDEX_THREADS),
+               SPHINX_NODE_COUNT=str(NODE_COUNT), SPHINX_NODE_ID=str(NODE_ID))
+    process = Popen([sys.executable, SPHINX_CONF], stdout=PIPE, env=env)
+    conf = process.communicate()[0]
+    assert(process.returncode==0)
+    commands = re.findall(r'^\s*tsvpipe_command\s*=\s*(.*)$', conf, re.M)
+    assert(len(commands)==2 * LOCAL_INDEX_THREADS)
+    # the input data of the test, the filter of the input data as of the image
+    commands = [re.sub(r'^.*? \| sed ', 'cat {} | sed '.format(data_filename), command) for command in commands]
+    if not ingest.which('gawk'):
+        commands = [command.replace('| gawk ', '| awk ') for command in commands]
+    return commands
+
+
+def read_shards(ingest_dir):
+    shards = sorted(name for name in listdir(ingest_dir) if ingest.SHARD_DIRECTORY.match(name))
+    return [''.join(open(path.join(ingest_dir, name, part), 'rb').read()
+                    for part in sorted(listdir(path.join(ingest_dir, name)))) for name in shards]
+
+
+try:
+    # valid rows, wrong number of columns, \r in a column, invalid and missing importance
+    lines = ['\t'.join(COLUMNS)]
+    for i in range(2, 200):
+        importance = ['0.5', '1e-3', '', '-0.2', 'invalid', '0.0000005', '0.9999999'][i % 7]
+        line = row(i, importance)
+        if i % 11 == 0:
+            line = line.rsplit('\t', 1)[0]
+        elif i % 13 == 0:
+            line += '\textra'
+        elif i % 17 == 0:
+            line = line.replace('name_en', 'name\ren', 1)
+        lines.append(line)
+    data_filename = path.join(directory, 'data.tsv')
+    with open(data_filename, 'wb') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    ingest.LOCAL_INDEX_THREADS = LOCAL_INDEX_THREADS
+    ingest.NODE_COUNT = NODE_COUNT
+    ingest.NODE_ID = NODE_ID
+    modulo = LOCAL_INDEX_THREADS * NODE_COUNT
+    remainders = [NODE_ID * LOCAL_INDEX_THREADS + i for i in range(LOCAL_INDEX_THREADS)]
+
+    #tests for the rows of the gawk filter of sphinx.conf
+
+    commands = tsvpipe_commands(data_filename, path.join(directory, 'missing'))
+    filtered = [run(command) for command in commands[0::2]]
+    texts = [run(command) for command in commands[1::2]]
+    assert(all(filtered) and all(texts))
+    assert('\r' not in ''.join(filtered))
+
+    # in chunks splitting the input at any line
+    data = open(data_filename, 'rb').read()
+    assert(ingest.parse_chunk(1, data, modulo, remainders)==filtered)
+    middle = data.index('\n', len(data) // 2) + 1
+    parts = zip(ingest.parse_chunk(1, data[:middle], modulo, remainders),
+                ingest.parse_chunk(data[:middle].count('\n') + 1, data[middle:], modulo, remainders))
+    assert([first + second for first, second in parts]==filtered)
+    print("test 1a passed")
+
+    # importance_rank as of gawk, 0 for negative, missing and invalid values
+    ranks = dict((line.split('\t')[0], line.rsplit('\t', 1)[1]) for line in ''.join(filtered).splitlines())
+    assert(ranks['21']=='500000' and ranks['15']=='1000' and ranks['27']=='1000000')
+    assert(ranks['9']=='0' and ranks['10']=='0' and ranks['4']=='0')
+    print("test 1b passed")
+
+    #tests for the shards of ingest() read by the sources of sphinx.conf
+
+    ingest_dir = path.join(directory, 'ingest')
+    ingest.CHUNK_SIZE = 1000
+    rows, size = ingest.ingest(data_filename, ingest_dir, processes=2, threads=1)
+    assert(rows==len(''.join(filtered).splitlines()) and size==len(data))
+    assert(read_shards(ingest_dir)==filtered)
+    print("test 2a passed")
+
+    commands = tsvpipe_commands(data_filename, ingest_dir)
+    assert([run(command) for command in commands[0::2]]==filtered)
+    assert([run(command) for command in commands[1::2]]==texts)
+    print("test 2b passed")
+
+    # compressed input, ingested again into the same directory
+    gz_filename = data_filename + '.gz'
+    with gzip.open(gz_filename, 'wb') as f:
+        f.write(data)
+    assert(ingest.ingest(gz_filename, ingest_dir, processes=1, threads=1)==(rows, size))
+    assert(read_shards(ingest_dir)==filtered)
+    print("test 2c passed")
+
+    #test for the rows read by the areas and prefixes indexes
+
+    all_rows = [(nr, line) for nr, line in ingest.read_rows(data_filename)]
+    assert(all_rows[0]==(2, lines[1]) and len(all_rows)==len(lines) - 1)
+    expected = sorted((nr, line.replace('\r', ' ')) for nr, line in all_rows
+                      if nr % modulo in remainders and line.count('\t')==len(COLUMNS) - 1)
+    assert(sorted(ingest.read_rows(ingest_dir))==expected)
+    assert([nr for nr, line in ingest.read_rows(gz_filename)]==[nr for nr, line in all_rows])
+    print("test 3 passed")
+finally:
+    shutil.rmtree(directory)
+
+times['end'] = time()
+times['duration'] = times['end'] - times['start']
+
+print "tests completed in ", times['duration']
@@ -0,0 +1,113 @@
+"""
+Unit tests for the metrics aggregation across processes (web/metrics.py)
+
+Workers are forked processes sharing a temporary metrics directory,
+no uwsgi or sphinx is needed: run from within the docker container,
+or from the repository.
+"""
+from os import _exit, close, fork, listdir, path, pipe, read, waitpid, write
+from time import time
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'web'))
+
+from metrics import Metrics
+
+times = {}
+times['start'] = time()
+
+directory = tempfile.mkdtemp()
+
+
+def registry():
+    metrics = Metrics(directory, flush_interval=0)
+    metrics.describe('requests_total', 'counter', 'Requests.')
+    metrics.describe('in_flight', 'gauge', 'Requests in flight.')
+    metrics.describe('duration_seconds', 'histogram', 'Duration.', buckets=(0.1, 1.0))
+    return metrics
+
+
+def worker(requests, in_flight, keep_alive=None):
+    """Fork a worker, which dumps its metrics, and exits (or waits for keep_alive pipe)."""
+    ready_read, ready_write = pipe()
+    pid = fork()
+    if pid == 0:
+        metrics = registry()
+        for i in range(requests):
+            metrics.inc('requests_total', {'route': '/r/'})
+            metrics.observe('duration_seconds', 0.5)
+        metrics.set('in_flight', in_flight)
+        metrics.flush(force=True)
+        write(ready_write, 'x')
+        if keep_alive is not None:
+            read(keep_alive, 1)
+        _exit(0)
+    close(ready_write)
+    read(ready_read, 1)
+    close(ready_read)
+    return pid
+
+
+def sample(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + ' ') or line.startswith(name + '{'):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+try:
+    main = registry()
+
+    #tests for the merge of finished and alive workers
+
+    for requests in (3, 4):
+        waitpid(worker(requests, 7), 0)
+    alive_read, alive_write = pipe()
+    alive = worker(5, 2, alive_read)
+
+    text = main.render()
+    assert(sample(text, 'requests_total')==12)
+    assert(sample(text, 'duration_seconds_count')==12)
+    assert(sample(text, 'duration_seconds_bucket{le="1.0"}')==12)
+    assert(sample(text, 'duration_seconds_bucket{le="0.1"}')==0)
+    # gauges of the finished workers are dropped, the alive worker and the scraping process stay
+    assert(sample(text, 'in_flight')==2)
+    print("test 1a passed")
+
+    # dumps of the finished workers are compacted and removed
+    files = listdir(directory)
+    assert('compacted.json' in files)
+    assert(len([f for f in files if f[0].isdigit() and f.endswith('.json')])==2)
+    assert(len([f for f in files if f[0].isdigit() and f.endswith('.lock')])==2)
+    print("test 1b passed")
+
+    # repeated scrapes do not count the compacted dumps again
+    text = main.render()
+    assert(sample(text, 'requests_total')==12)
+    print("test 1c passed")
+
+    #test for the worker finishing between scrapes
+
+    write(alive_write, 'x')
+    waitpid(alive, 0)
+    text = main.render()
+    assert(sample(text, 'requests_total')==12)
+    assert(sample(text, 'in_flight') is None)
+    assert(len([f for f in listdir(directory) if f[0].isdigit()])==2)
+    print("test 2 passed")
+
+    #test for the recycled worker with the reused pid, its own file is new
+
+    waitpid(worker(1, 0), 0)
+    text = main.render()
+    assert(sample(text, 'requests_total')==13)
+    print("test 3 passed")
+finally:
+    shutil.rmtree(directory)
+
+times['end'] = time()
+times['duration'] = times['end'] - times['start']
+
+print "tests completed in ", times['duration']
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the short prefixes index of autocomplete (web/prefixes.py)
+
+The index is built from a generated TSV file, no sphinx is needed:
+run from within the docker container, or from the repository.
+"""
+from os import path, remove
+from time import time
+import sys
+import tempfile
+sys.path.insert(0, '/usr/local/src/websearch')
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'web'))
+
+import prefixes
+from ingest import COLUMNS
+
+times = {}
+times['start'] = time()
+
+
+def row(name, importance, country_code='gb', alternative=''):
+    values = dict((col, '') for col in COLUMNS)
+    values.update({'name_en': name, 'name_de': alternative, 'osm_type': 'node', 'osm_id': '1',
+                   'class': 'place', 'type': 'city', 'lon': '-0.1275', 'lat': '51.507222',
+                   'place_rank': '16', 'importance': str(importance), 'country_code': country_code,
+                   'west': '-0.5', 'south': '51.2', 'east': '0.3', 'north': '51.7'})
+    return '\t'.join(values[col] for col in COLUMNS)
+
+
+def build_index(rows, countries=False):
+    data = tempfile.NamedTemporaryFile(suffix='.tsv', delete=False)
+    data.write('\t'.join(COLUMNS) + '\n')
+    for r in rows:
+        data.write(r + '\n')
+    data.close()
+    filename = data.name + '.bin'
+    try:
+        prefixes.build(data.name, filename, countries)
+        return prefixes.PrefixIndex(filename)
+    finally:
+        remove(data.name)
+        if path.isfile(filename):
+            remove(filename)
+
+
+# ids are line numbers, the header is line 1
+index = build_index([
+    row('London', 0.9),                               # id 2
+    row('Londonderry', 0.5),                          # id 3
+    row('Long Eaton', 0.5),                           # id 4
+    row('East London', 0.3, 'za'),                    # id 5
+    row(u'Löningen'.encode('utf-8'), 0.2, 'de'),      # id 6
+    row('Paris', 'invalid', 'fr', 'Lutetia'),         # id 7
+    row('Lo', 0.1),                                   # id 8
+    'invalid\trow',                                   # id 9
+], countries=True)
+
+#tests for the lookup of prefixes of the words of both names
+
+assert(index.lookup('lo')==[2, 3, 4, 5, 6, 8])
+assert(index.lookup('Lon')==[2, 3, 4, 5, 6])
+assert(index.lookup('ea')==[4, 5])
+assert(index.lookup('eat')==[4])
+assert(index.lookup('lut')==[7])
+assert(index.lookup('xyz')==[])
+print("test 1a passed")
+
+# without diacritics and case, as the charset_table of sphinx.conf
+assert(index.lookup(u'lÖn')==[2, 3, 4, 5, 6])
+assert(index.lookup('LON ')==[2, 3, 4, 5, 6])
+print("test 1b passed")
+
+# only 2 to 3 characters of one word are covered, the others are left to searchd
+assert(index.lookup('l') is None)
+assert(index.lookup('') is None)
+assert(index.lookup('lond') is None)
+assert(index.lookup('e l') is None)
+assert((index.min_len, index.max_len)==(prefixes.PREFIX_MIN_LEN, prefixes.PREFIX_MAX_LEN))
+print("test 1c passed")
+
+# per country prefixes
+assert(index.lookup('lon', 'GB')==[2, 3, 4])
+assert(index.lookup('lon', 'za')==[5])
+assert(index.lookup('lon', 'cz')==[])
+print("test 1d passed")
+
+#tests for the attributes of the kept places
+
+docs = index.documents([5, 2, 42])
+assert([doc['id'] for doc in docs]==[5, 2])
+attrs = docs[1]['attrs']
+assert(attrs['name_en']=='London' and attrs['country_code']=='gb' and attrs['osm_type']=='node')
+assert(attrs['importance']==0.9 and attrs['importance_rank']==900000)
+assert(attrs['lat']==51.507221 and attrs['west']==-0.5)
+assert(docs[0]['weight']==0)
+print("test 2a passed")
+
+# invalid importance is 0, as of searchd
+attrs = index.documents([7])[0]['attrs']
+assert(attrs['importance']==0.0 and attrs['importance_rank']==0)
+print("test 2b passed")
+
+#test for the number of kept places, ordered by importance and id
+
+index = build_index([row('Lima %d' % i, [0.5, 0.2, 0.7][i % 3]) for i in range(300)])
+ids = index.lookup('lim')
+assert(len(ids)==prefixes.PREFIX_TOP_N)
+expected = sorted(range(2, 302), key=lambda i: (-[0.5, 0.2, 0.7][(i - 2) % 3], i))
+assert(ids==expected[:prefixes.PREFIX_TOP_N])
+assert(index.lookup('lim', 'gb') is None)
+print("test 3 passed")
+
+#test for the file of another format
+
+data = tempfile.NamedTemporaryFile(delete=False)
+data.write('OSMNAMES-PREFIXES-2\n{}\n')
+data.close()
+try:
+    prefixes.PrefixIndex(data.name)
+    assert(False)
+except ValueError:
+    pass
+finally:
+    remove(data.name)
+print("test 4 passed")
+
+times['end'] = time()
+times['duration'] = times['end'] - times['start']
+
+print "tests completed in ", times['duration']
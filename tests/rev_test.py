@@ -260,6 +260,49 @@ test, distance = websearch.reverse_search(-178.7,-50.8,False);
 assert(test['results'][0][col_name]=='180 minus south')
 print("test 6i passed")
 
+#tests for k nearest places, sorted by distance
+
+test, distance = websearch.reverse_search(25.0,25.0,[],False,limit=2);
+assert([row['attrs'][col_name] for row in test['matches']]==['NE quadrant 1','NE quadrant 2'])
+assert(test['matches'][0]['attrs']['distance']<=test['matches'][1]['attrs']['distance'])
+print("test 8a passed")
+
+# the nearest place is across the 180 meridian, a farther one is on the same side
+test, distance = websearch.reverse_search(-179.6,41.0,[],False,limit=2);
+assert([row['attrs'][col_name] for row in test['matches']]==['180 plus north','180 minus north'])
+assert(float(test['matches'][0]['attrs']['lon'])>0)
+assert(distance<test['matches'][1]['attrs']['distance'])
+print("test 8b passed")
+
+#tests for the viewport search paging, the places of the grid tie in importance
+
+def bbox_pages(west, south, east, north, count):
+    ids = []
+    cursor = None
+    while True:
+        test = websearch.bbox_search(west, south, east, north, count, cursor, time() + 5)
+        assert(test['status'])
+        assert(len(test['matches'])<=count)
+        ids.extend(row['id'] for row in test['matches'])
+        cursor = test['next_cursor']
+        if cursor is None:
+            return ids
+
+test = websearch.bbox_search(44.0,44.0,44.0001,44.0001,100,None,time() + 5)
+all_ids = sorted(row['id'] for row in test['matches'])
+assert(len(all_ids)==25)
+for count in [1, 2, 3, 7, 25]:
+    ids = bbox_pages(44.0,44.0,44.0001,44.0001,count)
+    assert(len(ids)==len(set(ids)))
+    assert(sorted(ids)==all_ids)
+print("test 9a passed")
+
+ids = bbox_pages(179.0,30.0,-179.0,60.0,1)
+test = websearch.bbox_search(179.0,30.0,-179.0,60.0,100,None,time() + 5)
+assert(len(ids)==2)
+assert(sorted(ids)==sorted(row['id'] for row in test['matches']))
+print("test 9b passed")
+
 #test for full result set (>20 records)
 """
 test, distance = websearch.reverse_search(44.000025,44.000025,True);
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Admission control of SphinxQL work for OSMNames-SphinxSearch WebSearch
+#
+# The concurrency limit and the queue are shared by all worker processes
+# through a System V semaphore. The permits are taken with SEM_UNDO, so the
+# kernel returns them even if the worker dies (uwsgi harakiri), and the queued
+# requests block in semtimedop until a permit is released or they time out.
+# Every configured limit has its own semaphore set, sized once when created.
+# The gevent serving mode (one process) uses a gevent semaphore instead.
+
+from os import getenv, makedirs, path
+from time import sleep, time
+import ctypes
+import ctypes.util
+import errno
+
+
+ADMISSION_DIR = '/tmp/osmnames-sphinxsearch-admission'
+if getenv('ADMISSION_DIR'):
+    ADMISSION_DIR = getenv('ADMISSION_DIR')
+
+
+def get_workers():
+    """Number of uwsgi worker processes, 6 (supervisor/web.conf) outside of uwsgi."""
+    try:
+        import uwsgi
+        return uwsgi.numproc
+    except (ImportError, AttributeError):
+        return 6
+
+
+# Maximum number of requests running SphinxQL queries at once, one worker
+# is kept free for /metrics and the requests served from the memory indexes
+ADMISSION_MAX_CONCURRENT = max(1, get_workers() - 1)
+if getenv('ADMISSION_MAX_CONCURRENT'):
+    ADMISSION_MAX_CONCURRENT = int(getenv('ADMISSION_MAX_CONCURRENT'))
+
+# Maximum number of requests waiting for a free slot, 0 sheds immediately
+ADMISSION_MAX_QUEUE = get_workers()
+if getenv('ADMISSION_MAX_QUEUE'):
+    ADMISSION_MAX_QUEUE = int(getenv('ADMISSION_MAX_QUEUE'))
+
+# Maximum time spent in the queue, in seconds
+ADMISSION_QUEUE_TIMEOUT = 0.5
+if getenv('ADMISSION_QUEUE_TIMEOUT'):
+    ADMISSION_QUEUE_TIMEOUT = float(getenv('ADMISSION_QUEUE_TIMEOUT'))
+
+
+# System V semaphores (Linux values of sys/ipc.h and sys/sem.h)
+IPC_CREAT = 0o1000
+IPC_EXCL = 0o2000
+IPC_NOWAIT = 0o4000
+SEM_UNDO = 0x1000
+GETVAL = 12
+GETNCNT = 14
+SETVAL = 16
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+class _Sembuf(ctypes.Structure):
+    _fields_ = [('sem_num', ctypes.c_ushort), ('sem_op', ctypes.c_short), ('sem_flg', ctypes.c_short)]
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _check(result):
+    if result == -1:
+        code = ctypes.get_errno()
+        raise OSError(code, errno.errorcode.get(code, str(code)))
+    return result
+
+
+class SharedSemaphore(object):
+    """
+    Counting semaphore shared by the processes using the same directory and value.
+
+    The set is keyed by the value (a subdirectory of the directory), so a process
+    with another configuration (e.g. reverse_bulk.py or a restart with another
+    number of workers) gets its own set and never resizes the live one.
+    Semaphore 0 holds the free permits, semaphore 1 is set when it is initialized.
+    """
+
+    def __init__(self, directory, value):
+        directory = path.join(directory, 'permits-{}'.format(value))
+        if not path.isdir(directory):
+            try:
+                makedirs(directory)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        key = _check(_libc.ftok(directory, ord('A')))
+        try:
+            self.semid = _check(_libc.semget(key, 2, IPC_CREAT | IPC_EXCL | 0o600))
+            # Only the process creating the set sizes it
+            _check(_libc.semctl(self.semid, 0, SETVAL, value))
+            _check(_libc.semctl(self.semid, 1, SETVAL, 1))
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+            self.semid = _check(_libc.semget(key, 2, 0o600))
+            until = time() + 1.0
+            while not _check(_libc.semctl(self.semid, 1, GETVAL)) and time() < until:
+                sleep(0.001)
+
+    def acquire(self, timeout):
+        """Take a permit, wait at most timeout seconds (0 does not wait), return True if taken."""
+        until = time() + timeout
+        while True:
+            op = _Sembuf(0, -1, SEM_UNDO | (IPC_NOWAIT if timeout <= 0 else 0))
+            remaining = until - time()
+            wait = _Timespec(int(remaining), int((remaining % 1) * 1e9))
+            if timeout <= 0:
+                result = _libc.semop(self.semid, ctypes.byref(op), 1)
+            elif remaining <= 0:
+                return False
+            else:
+                result = _libc.semtimedop(self.semid, ctypes.byref(op), 1, ctypes.byref(wait))
+            if result == 0:
+                return True
+            code = ctypes.get_errno()
+            if code == errno.EAGAIN:
+                return False
+            if code != errno.EINTR:
+                raise OSError(code, errno.errorcode.get(code, str(code)))
+
+    def release(self):
+        op = _Sembuf(0, 1, SEM_UNDO)
+        _check(_libc.semop(self.semid, ctypes.byref(op), 1))
+
+    def waiting(self):
+        """Number of processes waiting for a permit."""
+        return _check(_libc.semctl(self.semid, 0, GETNCNT))
+
+
+class LocalSemaphore(object):
+    """Counting semaphore of greenlets of one gevent process."""
+
+    def __init__(self, value):
+        from gevent.lock import BoundedSemaphore
+        self.semaphore = BoundedSemaphore(value)
+        self.waiters = 0
+
+    def acquire(self, timeout):
+        if timeout <= 0:
+            return self.semaphore.acquire(blocking=False)
+        self.waiters += 1
+        try:
+            return self.semaphore.acquire(timeout=timeout)
+        finally:
+            self.waiters -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+    def waiting(self):
+        return self.waiters
+
+
+class AdmissionControl(object):
+    """Concurrency limit with a bounded queue, shared across processes by default."""
+
+    def __init__(self, directory=ADMISSION_DIR, max_concurrent=ADMISSION_MAX_CONCURRENT,
+                 max_queue=ADMISSION_MAX_QUEUE, queue_timeout=ADMISSION_QUEUE_TIMEOUT, semaphore=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.semaphore = semaphore or SharedSemaphore(directory, max_concurrent)
+
+    def release(self, slot):
+        """Release the slot."""
+        self.semaphore.release()
+
+    def acquire(self, deadline=None, on_queue=None):
+        """
+        Get a slot for SphinxQL work.
+
+        Waits in the queue at most queue_timeout seconds (or until the deadline).
+        on_queue(delta) is called when entering (+1) and leaving (-1) the queue.
+        Return True, or None if the request has to be shed.
+        """
+        if self.semaphore.acquire(0):
+            return True
+        if self.max_queue <= 0 or self.semaphore.waiting() >= self.max_queue:
+            return None
+
+        timeout = self.queue_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time())
+        if timeout <= 0:
+            return None
+        if on_queue:
+            on_queue(1)
+        try:
+            return self.semaphore.acquire(timeout) or None
+        finally:
+            if on_queue:
+                on_queue(-1)
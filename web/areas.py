@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Containing areas index for OSMNames-SphinxSearch
+#
+# Packed R-tree over the bounding boxes (west/south/east/north) of the
+# boundary and place rows of the input data. It is built at reindex time:
+#
+#   python areas.py /data/ingest /data/index/areas.bin
+#
+# from the rows of the ingest directory (or from the input data, see
+# ingest.read_rows) and loaded by the WebSearch to find areas containing a point without
+# any GEODIST scan. Ids are the document ids of the sphinx indexes (the line
+# number of the row in the input data, as assigned by the tsvpipe source).
+
+from array import array
+from json import dumps, loads
+from os import path, rename
+from time import time
+import math
+import sys
+
+from ingest import COLUMNS, read_rows
+
+
+AREAS_MAGIC = 'OSMNAMES-AREAS-1\n'
+
+# Classes of rows, whose bounding box is an area
+AREA_CLASSES = ['boundary', 'place']
+
+# Number of children of one R-tree node
+NODE_SIZE = 16
+
+
+def read_areas(filename):
+    """Read (id, class, place_rank, west, south, east, north) of area rows from the TSV data (or ingest directory)."""
+    col_class = COLUMNS.index('class')
+    col_rank = COLUMNS.index('place_rank')
+    col_west = COLUMNS.index('west')
+    for nr, line in read_rows(filename):
+        cols = line.split('\t')
+        if len(cols) != len(COLUMNS) or cols[col_class] not in AREA_CLASSES:
+            continue
+        try:
+            rank = int(float(cols[col_rank]))
+            west, south, east, north = [float(v) for v in cols[col_west:col_west + 4]]
+        except ValueError:
+            continue
+        # Points do not contain anything
+        if west == east or south >= north:
+            continue
+        yield nr, AREA_CLASSES.index(cols[col_class]), rank, west, south, east, north
+
+
+def build(input_filename, output_filename):
+    """Build packed R-tree (Sort-Tile-Recursive leaves) and store it into the file."""
+    ids = array('i')
+    classes = array('b')
+    ranks = array('b')
+    boxes = []
+    for nr, cl, rank, west, south, east, north in read_areas(input_filename):
+        # Split bounding boxes spanning the 180 meridian
+        parts = [(west, south, east, north)]
+        if west > east:
+            parts = [(west, south, 180.0, north), (-180.0, south, east, north)]
+        for box in parts:
+            boxes.append((box, len(ids)))
+            ids.append(nr)
+            classes.append(cl)
+            ranks.append(rank)
+
+    # Sort-Tile-Recursive order of the leaves: vertical slabs ordered by the center
+    count = len(boxes)
+    slab = int(math.ceil(math.sqrt(max(count, 1) / float(NODE_SIZE)))) * NODE_SIZE
+    boxes.sort(key=lambda item: item[0][0] + item[0][2])
+    ordered = []
+    for i in range(0, count, slab):
+        ordered.extend(sorted(boxes[i:i + slab], key=lambda item: item[0][1] + item[0][3]))
+
+    leaf_ids = array('i', [ids[i] for box, i in ordered])
+    leaf_classes = array('b', [classes[i] for box, i in ordered])
+    leaf_ranks = array('b', [ranks[i] for box, i in ordered])
+    level = array('f')
+    for box, i in ordered:
+        level.extend(box)
+
+    # Upper levels group NODE_SIZE consecutive nodes
+    levels = [level]
+    while len(level) > 4:
+        upper = array('f')
+        for i in range(0, len(level), 4 * NODE_SIZE):
+            chunk = level[i:i + 4 * NODE_SIZE]
+            upper.extend([min(chunk[0::4]), min(chunk[1::4]), max(chunk[2::4]), max(chunk[3::4])])
+        levels.append(upper)
+        level = upper
+
+    header = {
+        'count': count,
+        'node_size': NODE_SIZE,
+        'levels': [len(level) // 4 for level in levels],
+        'classes': AREA_CLASSES,
+    }
+    tmp = output_filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(AREAS_MAGIC)
+        f.write(dumps(header) + '\n')
+        leaf_ids.tofile(f)
+        leaf_classes.tofile(f)
+        leaf_ranks.tofile(f)
+        for level in levels:
+            level.tofile(f)
+    rename(tmp, output_filename)
+    return count
+
+
+class AreaIndex(object):
+    """Packed R-tree of areas, loaded from the file built by build()."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = path.getmtime(filename)
+        with open(filename, 'rb') as f:
+            if f.readline() != AREAS_MAGIC:
+                raise ValueError('Unknown format of areas file {}'.format(filename))
+            header = loads(f.readline())
+            count = header['count']
+            self.node_size = header['node_size']
+            self.classes = header['classes']
+            self.ids = array('i')
+            self.ids.fromfile(f, count)
+            self.entry_classes = array('b')
+            self.entry_classes.fromfile(f, count)
+            self.ranks = array('b')
+            self.ranks.fromfile(f, count)
+            # levels[0] are leaves, levels[-1] is the root
+            self.levels = []
+            for size in header['levels']:
+                level = array('f')
+                level.fromfile(f, 4 * size)
+                self.levels.append(level)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def contains(self, lon, lat, classes=None):
+        """
+        Find areas containing the point.
+
+        Return list of (id, class, place_rank), ordered by place_rank descending
+        (the smallest areas first).
+        """
+        if not self.ids:
+            return []
+        class_codes = None
+        if classes:
+            class_codes = set(self.classes.index(cl) for cl in classes if cl in self.classes)
+        size = self.node_size
+        # Descend from the root, nodes contains indexes of the current level
+        nodes = [0]
+        for depth in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[depth]
+            found = []
+            for i in nodes:
+                j = 4 * i
+                if level[j] <= lon <= level[j + 2] and level[j + 1] <= lat <= level[j + 3]:
+                    found.append(i)
+            if depth == 0:
+                nodes = found
+                break
+            count = len(self.levels[depth - 1]) // 4
+            nodes = [c for i in found for c in range(i * size, min((i + 1) * size, count))]
+
+        areas = []
+        seen = set()
+        for i in nodes:
+            if class_codes is not None and self.entry_classes[i] not in class_codes:
+                continue
+            if self.ids[i] in seen:
+                continue
+            seen.add(self.ids[i])
+            areas.append((self.ids[i], self.classes[self.entry_classes[i]], self.ranks[i]))
+        areas.sort(key=lambda area: -area[2])
+        return areas
+
+
+"""
+Main launcher
+"""
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: {} <data.tsv[.gz]|ingest_dir> <areas.bin>'.format(sys.argv[0]))
+        sys.exit(1)
+    start = time()
+    count = build(sys.argv[1], sys.argv[2])
+    print('Areas index: {} areas built in {:.1f} seconds'.format(count, time() - start))
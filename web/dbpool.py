@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SphinxQL connection pool for OSMNames-SphinxSearch WebSearch
+#
+# Idle connections are kept for reuse by the following requests of the
+# process, at most size connections (in use and idle) are open, further
+# requests wait for a returned one. Safe for threads and for gevent
+# (monkey patched threading).
+# With more SphinxQL endpoints, the least loaded healthy endpoint is used
+# and the failed endpoints are skipped for a while (failover), a query which
+# lost its connection can be retried on the next endpoint.
+
+from os import getpid
+from time import sleep, time
+import itertools
+import threading
+
+
+class PoolTimeout(Exception):
+    """All connections stayed in use until the deadline."""
+    pass
+
+
+class PooledConnection(object):
+    """Connection proxy, close() returns the connection into the pool."""
+
+    def __init__(self, pool, db):
+        self.pool = pool
+        self.db = db
+        # Endpoint of the connection, set by BalancedPool
+        self.endpoint = None
+
+    def close(self):
+        if self.db is not None:
+            self.pool.put(self.db)
+            self.db = None
+
+    def discard(self):
+        """Close the underlying connection, e.g. after a connection error."""
+        if self.db is not None:
+            self.pool.discard(self.db)
+            self.db = None
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class ConnectionPool(object):
+    """
+    Pool of at most size connections created by connect().
+
+    Connections idle longer than ping_after seconds are checked before reuse,
+    connections idle longer than max_idle seconds are closed.
+    """
+
+    def __init__(self, connect, size, max_idle=20.0, ping_after=1.0):
+        self.connect = connect
+        self.size = size
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.lock = threading.Lock()
+        self.idle = []
+        self.pid = getpid()
+        # Number of connections handed out and not returned yet
+        self.in_flight = 0
+        # Connections in use or idle, a new one is opened only without an idle one
+        self.slots = threading.BoundedSemaphore(size)
+
+    def _check_fork(self):
+        # Connections must not be shared with the forked workers
+        if self.pid != getpid():
+            self.pid = getpid()
+            self.idle = []
+            self.in_flight = 0
+            self.slots = threading.BoundedSemaphore(self.size)
+
+    def get(self, blocking=True, timeout=None):
+        """
+        Get pooled connection.
+
+        None if all connections are in use and not blocking, or still in use after timeout seconds.
+        """
+        with self.lock:
+            self._check_fork()
+            slots = self.slots
+        if not self._acquire(slots, blocking, timeout):
+            return None
+        try:
+            db = self._get()
+        except:
+            slots.release()
+            raise
+        with self.lock:
+            self.in_flight += 1
+        return PooledConnection(self, db)
+
+    def _acquire(self, slots, blocking, timeout):
+        if not blocking or timeout is None:
+            return slots.acquire(blocking)
+        # Semaphores of Python 2 threading have no timeout, poll as threading.Condition.wait does
+        until = time() + timeout
+        delay = 0.0005
+        while not slots.acquire(False):
+            remaining = until - time()
+            if remaining <= 0:
+                return False
+            delay = min(delay * 2, remaining, 0.05)
+            sleep(delay)
+        return True
+
+    def _get(self):
+        while True:
+            with self.lock:
+                item = self.idle.pop() if self.idle else None
+            if item is None:
+                return self.connect()
+            db, since = item
+            idle = time() - since
+            if idle > self.max_idle:
+                self._close(db)
+                continue
+            if idle > self.ping_after:
+                try:
+                    db.ping()
+                except Exception:
+                    self._close(db)
+                    continue
+            return db
+
+    def put(self, db):
+        with self.lock:
+            self.in_flight -= 1
+            self.idle.append((db, time()))
+        self.slots.release()
+
+    def discard(self, db):
+        with self.lock:
+            self.in_flight -= 1
+        self._close(db)
+        self.slots.release()
+
+    def _close(self, db):
+        try:
+            db.close()
+        except Exception:
+            pass
+
+
+class Endpoint(object):
+    """SphinxQL endpoint with its own connection pool and health state."""
+
+    def __init__(self, host, port, pool):
+        self.host = host
+        self.port = port
+        self.pool = pool
+        self.down_until = 0
+
+    def __str__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+
+class BalancedPool(object):
+    """
+    Connection pools of more SphinxQL endpoints.
+
+    get() prefers healthy endpoints with the least connections in flight,
+    round-robin among equally loaded ones, and waits for a returned
+    connection only if all endpoints use all their connections. Endpoint
+    failing to connect (or losing the connection of a query, see failover())
+    is marked down for retry_after seconds and the next one is tried.
+    """
+
+    def __init__(self, servers, connect, size, retry_after=5.0, **kwargs):
+        self.endpoints = []
+        for host, port in servers:
+            pool = ConnectionPool(lambda host=host, port=port: connect(host, port), size, **kwargs)
+            self.endpoints.append(Endpoint(host, port, pool))
+        self.retry_after = retry_after
+        self.counter = itertools.count()
+
+    def get(self, deadline=None):
+        """
+        Get pooled connection of the best endpoint.
+
+        Waits for a returned connection at most until the deadline, then raises PoolTimeout.
+        """
+        now = time()
+        offset = next(self.counter)
+        count = len(self.endpoints)
+        # Rotate for round-robin, healthy endpoints first, then by load
+        rotated = [self.endpoints[(offset + i) % count] for i in range(count)]
+        candidates = sorted(rotated, key=lambda ep: (ep.down_until > now, ep.pool.in_flight))
+        error = None
+        failed = set()
+        for blocking in (False, True):
+            for endpoint in candidates:
+                if endpoint in failed:
+                    continue
+                timeout = None
+                if blocking and deadline is not None:
+                    timeout = max(0, deadline - time())
+                try:
+                    db = endpoint.pool.get(blocking, timeout)
+                except Exception as ex:
+                    endpoint.down_until = time() + self.retry_after
+                    print('SphinxQL endpoint {} is down: {}'.format(endpoint, ex))
+                    failed.add(endpoint)
+                    error = ex
+                    continue
+                if db is None:
+                    if timeout is not None:
+                        raise PoolTimeout('All SphinxQL connections are in use')
+                    continue
+                endpoint.down_until = 0
+                db.endpoint = endpoint
+                return db
+        if error is None:
+            raise RuntimeError('No SphinxQL endpoint configured')
+        raise error
+
+    def failover(self, db, reason, deadline=None):
+        """
+        Discard the connection lost by a query, mark its endpoint down and get a connection of the next endpoint.
+
+        The only endpoint is reconnected (e.g. after restart of searchd).
+        """
+        endpoint = db.endpoint
+        db.discard()
+        if endpoint is not None:
+            endpoint.down_until = time() + self.retry_after
+            print('SphinxQL endpoint {} is down: {}'.format(endpoint, reason))
+        return self.get(deadline)
+
+    def status(self):
+        """Health and load of the endpoints."""
+        now = time()
+        return [{'endpoint': str(ep), 'up': ep.down_until <= now, 'in_flight': ep.pool.in_flight}
+                for ep in self.endpoints]
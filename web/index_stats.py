@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Index statistics and capacity report for OSMNames-SphinxSearch
+#
+# Run after sphinx-reindex.sh, it reports for each index and shard the number
+# of documents, the size on disk by file type and the memory footprint of the
+# attributes, the indexing time of each reindex stage (from the reindex log),
+# and recommends memory and shard settings of sphinx.conf for this host:
+#
+#   python index_stats.py [/data/index] [/tmp/osmnames-sphinxsearch-index-stats.json]
+
+from json import dumps
+from multiprocessing import cpu_count
+from os import listdir, path, rename
+from time import strftime
+import math
+import re
+import subprocess
+import sys
+
+
+INDEX_DIR = '/data/index'
+REINDEX_LOG = '/var/log/sphinxsearch/sphinx-reindex.log'
+# Stored next to the data timestamp of websearch.py
+STATS_FILE = '/tmp/osmnames-sphinxsearch-index-stats.json'
+
+# Sphinx index files: <index>_<shard>[.new].<ext>, .new are waiting for rotation
+INDEX_FILE = re.compile(r'^(?P<index>ind_[a-z_]+)_(?P<shard>\d+)(?P<new>\.new)?\.(?P<ext>sp[a-z])$')
+
+# Files mapped into memory: attributes (spa), strings (sps), MVA (spm), dictionary (spi), kill-list (spk)
+ATTR_EXTS = ['spa', 'sps', 'spm']
+MEMORY_EXTS = ATTR_EXTS + ['spi', 'spk']
+
+# Recommendation limits
+MEM_LIMIT_MAX_MB = 2047
+READ_BUFFER_MIN = 256 * 1024
+READ_BUFFER_MAX = 8 * 1024 * 1024
+MAX_CHILDREN = 64
+# Documents per shard (local index), the shards are indexed and searched in parallel
+SHARD_TARGET_DOCS = 2000000
+
+
+def index_files(index_dir):
+    """Sizes of the index files, {(index, shard): {ext: bytes}}, the files waiting for rotation preferred."""
+    found = {}
+    for filename in listdir(index_dir):
+        m = INDEX_FILE.match(filename)
+        if m is None:
+            continue
+        key = (m.group('index'), int(m.group('shard')))
+        new = m.group('new') is not None
+        files = found.setdefault(key, {True: {}, False: {}})
+        files[new][m.group('ext')] = path.getsize(path.join(index_dir, filename))
+    result = {}
+    for key, files in found.items():
+        result[key] = dict(files[False])
+        result[key].update(files[True])
+    return result
+
+
+def last_reindex_log(filename):
+    """Lines of the last reindex run in the log."""
+    if not path.isfile(filename):
+        return []
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    for i in range(len(lines) - 1, -1, -1):
+        if lines[i].startswith('Reindex started'):
+            return lines[i:]
+    return []
+
+
+def parse_indexer_log(lines):
+    """Documents, bytes and seconds of each index from the indexer output."""
+    indexes = {}
+    current = None
+    for line in lines:
+        m = re.match(r"^indexing index '([^']+)'", line)
+        if m:
+            current = indexes.setdefault(m.group(1), {})
+            continue
+        if current is None:
+            continue
+        m = re.match(r'^total (\d+) docs, (\d+) bytes', line)
+        if m:
+            current['documents'] = int(m.group(1))
+            current['source_bytes'] = int(m.group(2))
+            continue
+        m = re.match(r'^total ([\d.]+) sec', line)
+        if m:
+            current['seconds'] = float(m.group(1))
+            current = None
+    return indexes
+
+
+def parse_stages(lines):
+    """Seconds of the reindex stages, from 'Stage <name>: <seconds> seconds' lines."""
+    stages = {}
+    for line in lines:
+        m = re.match(r'^Stage ([\w-]+): ([\d.]+) seconds', line)
+        if m:
+            stages[m.group(1)] = float(m.group(2))
+    return stages
+
+
+def header_documents(index_dir, name):
+    """Number of documents from the index header, if indextool is available."""
+    try:
+        output = subprocess.check_output(
+            ['indextool', '--dumpheader', path.join(index_dir, name + '.sph')],
+            stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    m = re.search(r'^total-documents: (\d+)', output, re.MULTILINE)
+    return int(m.group(1)) if m else None
+
+
+def host_memory():
+    """Total memory of the host in bytes."""
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def power_of_two(value, low, high):
+    value = max(low, min(high, value))
+    return 2 ** int(math.log(value, 2))
+
+
+def recommend(stats, memory, cpus):
+    """Recommended sphinx.conf settings (environment variables) for the host."""
+    docs = max(index['documents'] or 0 for index in stats['indexes'].values()) if stats['indexes'] else 0
+    memory_bytes = stats['totals']['memory_bytes']
+    disk_bytes = stats['totals']['disk_bytes']
+    recommendation = {}
+    reasons = []
+
+    # Indexer runs one index at a time, keep most of the memory for searchd and page cache
+    mem_limit = max(128, min(MEM_LIMIT_MAX_MB, memory // 4 // 2 ** 20))
+    recommendation['SPHINX_MEM_LIMIT'] = '{}M'.format(mem_limit)
+
+    # Per-keyword buffer of every query, the whole pool should stay within ~2% of memory
+    read_buffer = power_of_two(memory // 50 // (MAX_CHILDREN * 8), READ_BUFFER_MIN, READ_BUFFER_MAX)
+    recommendation['SPHINX_READ_BUFFER'] = '{}K'.format(read_buffer // 1024)
+
+    # Attributes in RAM, if they together with the dictionaries fit into a quarter of memory
+    ondisk = 0 if memory_bytes < memory // 4 else 1
+    recommendation['SPHINX_ONDISK_ATTRS'] = ondisk
+    if ondisk:
+        reasons.append('attributes and dictionaries ({} MB) exceed a quarter of memory, keep them on disk'.format(
+            memory_bytes // 2 ** 20))
+
+    # Shards are searched in parallel (dist_threads), no more than CPUs
+    shards = max(1, min(cpus, int(math.ceil(docs / float(SHARD_TARGET_DOCS)))))
+    recommendation['SPHINX_LOCAL_INDEX_THREADS'] = shards
+
+    # Index which does not fit into the page cache should be split among more nodes
+    nodes = max(1, int(math.ceil(disk_bytes / (memory * 0.7))))
+    if nodes > 1:
+        recommendation['SPHINX_NODE_COUNT'] = nodes
+        reasons.append('index ({} MB) exceeds 70% of memory, split it among {} nodes'.format(
+            disk_bytes // 2 ** 20, nodes))
+    recommendation['reasons'] = reasons
+    return recommendation
+
+
+def collect(index_dir, log_filename):
+    """Statistics of the indexes in index_dir."""
+    log = last_reindex_log(log_filename)
+    indexer = parse_indexer_log(log)
+    indexes = {}
+    for (index, shard), files in sorted(index_files(index_dir).items()):
+        name = '{}_{}'.format(index, shard)
+        documents = indexer.get(name, {}).get('documents')
+        if documents is None:
+            documents = header_documents(index_dir, name)
+        shard_stats = {
+            'documents': documents,
+            'files': files,
+            'disk_bytes': sum(files.values()),
+            'attr_bytes': sum(files.get(ext, 0) for ext in ATTR_EXTS),
+            'memory_bytes': sum(files.get(ext, 0) for ext in MEMORY_EXTS),
+            'seconds': indexer.get(name, {}).get('seconds'),
+        }
+        item = indexes.setdefault(index, {'shards': {}})
+        item['shards'][shard] = shard_stats
+
+    for item in indexes.values():
+        shards = item['shards'].values()
+        for key in ['documents', 'disk_bytes', 'attr_bytes', 'memory_bytes', 'seconds']:
+            values = [shard[key] for shard in shards if shard[key] is not None]
+            item[key] = sum(values) if values else None
+
+    totals = {}
+    for key in ['disk_bytes', 'attr_bytes', 'memory_bytes']:
+        totals[key] = sum(item[key] for item in indexes.values())
+    return {
+        'created': strftime('%Y-%m-%d %H:%M:%S'),
+        'index_dir': index_dir,
+        'indexes': indexes,
+        'totals': totals,
+        'stages': parse_stages(log),
+    }
+
+
+def main(index_dir, output_filename):
+    stats = collect(index_dir, REINDEX_LOG)
+    memory = host_memory()
+    cpus = cpu_count()
+    stats['host'] = {'memory_bytes': memory, 'cpus': cpus}
+    if memory and stats['indexes']:
+        stats['recommendation'] = recommend(stats, memory, cpus)
+
+    tmp = output_filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(dumps(stats, indent=2, sort_keys=True))
+    rename(tmp, output_filename)
+
+    for index, item in sorted(stats['indexes'].items()):
+        print('Index {}: {} shards, {} documents, {:.1f} MB on disk, {:.1f} MB attributes'.format(
+            index, len(item['shards']), item['documents'],
+            item['disk_bytes'] / 2.0 ** 20, item['attr_bytes'] / 2.0 ** 20))
+    for stage, seconds in sorted(stats['stages'].items()):
+        print('Stage {}: {:.0f} seconds'.format(stage, seconds))
+    for key, value in sorted(stats.get('recommendation', {}).items()):
+        if key != 'reasons':
+            print('Recommended {}={}'.format(key, value))
+    for reason in stats.get('recommendation', {}).get('reasons', []):
+        print('Recommendation: {}'.format(reason))
+
+
+"""
+Main launcher
+"""
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        print('Usage: {} [index_dir] [stats.json]'.format(sys.argv[0]))
+        sys.exit(1)
+    main(sys.argv[1] if len(sys.argv) > 1 else INDEX_DIR,
+         sys.argv[2] if len(sys.argv) > 2 else STATS_FILE)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Parallel ingest of the input data for OSMNames-SphinxSearch
+#
+# Decompresses the input data once and validates the rows in parallel chunks
+# into one directory per local index of this node (a part file per chunk, in the
+# input order), read by the tsvpipe sources of sphinx.conf instead of the gzip
+# pipe, and by the areas and prefixes indexes (see read_rows):
+#
+#   python ingest.py /data/input/data.tsv.gz /data/ingest
+#
+# Only block-gzip (bgzip) data are decompressed in more threads. Plain gzip is
+# inflated by one thread (pigz only moves reading, writing and the checksum to
+# other threads) and so is zstd, its -T option parallelizes the compression only.
+#
+# The rows are the same as of the gawk filter of sphinx.conf: without the
+# header, with 17 columns, \r replaced by space, prefixed by the line number
+# (the document id), suffixed by the importance scaled to an integer (the exact
+# sort key of the viewport search) and partitioned by the line number among the
+# nodes and local indexes (SPHINX_NODE_COUNT, SPHINX_NODE_ID, SPHINX_LOCAL_INDEX_THREADS).
+
+from contextlib import contextmanager
+from multiprocessing import Pool, cpu_count
+from os import getenv, listdir, makedirs, path, remove, rename
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from time import time
+import re
+import sys
+
+from parallel import ordered_map
+
+
+# Columns of the input data (see tsvpipe source in sphinx.conf)
+COLUMNS = ['name_en', 'name_de', 'osm_type', 'osm_id', 'class', 'type',
+           'lon', 'lat', 'place_rank', 'importance', 'country_en', 'country_de',
+           'country_code', 'west', 'south', 'east', 'north']
+COLUMN_COUNT = len(COLUMNS)
+COLUMN_IMPORTANCE = COLUMNS.index('importance')
+
+# Scale of the integer importance_rank attribute, same as of the gawk filter of sphinx.conf
+IMPORTANCE_RANK_SCALE = 1000000
+
+# Bytes of the decompressed data parsed by one task
+CHUNK_SIZE = 16 * 1024 * 1024
+
+LOCAL_INDEX_THREADS = int(getenv('SPHINX_LOCAL_INDEX_THREADS', '4'))
+NODE_COUNT = int(getenv('SPHINX_NODE_COUNT', '1'))
+NODE_ID = int(getenv('SPHINX_NODE_ID', '0'))
+
+
+# Directory of the rows of one local index, see shard_directory
+SHARD_DIRECTORY = re.compile(r'^data_\d+_of_\d+$')
+
+
+def shard_directory(directory, remainder, modulo):
+    """Directory of the rows with line number % modulo == remainder (see sphinx.conf)."""
+    return path.join(directory, 'data_{}_of_{}'.format(remainder, modulo))
+
+
+def which(program):
+    for directory in getenv('PATH', '').split(':'):
+        if path.isfile(path.join(directory, program)):
+            return True
+    return False
+
+
+def is_bgzf(filename):
+    """Block-gzip (bgzip) file, gzip header with the BC extra subfield."""
+    with open(filename, 'rb') as f:
+        header = f.read(14)
+    return len(header) == 14 and header[:2] == '\x1f\x8b' and bool(ord(header[3]) & 4) and header[12:14] == 'BC'
+
+
+def decompress_command(filename, threads=None):
+    """Command decompressing the file to stdout, None for uncompressed file."""
+    threads = str(threads or cpu_count())
+    if filename.endswith('.zst'):
+        return ['zstd', '-d', '-c', '-q', filename]
+    if not filename.endswith('.gz') and not filename.endswith('.bgz'):
+        return None
+    # Blocks of bgzip are decompressed in parallel, pigz inflates in one thread but
+    # reads, writes and checks in others, gzip is always available
+    if is_bgzf(filename) and which('bgzip'):
+        return ['bgzip', '-d', '-c', '-@', threads, filename]
+    if which('pigz'):
+        return ['pigz', '-d', '-c', '-p', threads, filename]
+    return ['gzip', '-d', '-c', filename]
+
+
+@contextmanager
+def open_data(filename, threads=None):
+    """Open the input data, decompressed by the fastest available decompressor."""
+    command = decompress_command(filename, threads)
+    if command is None:
+        with open(filename, 'rb') as f:
+            yield f
+        return
+    process = Popen(command, stdout=PIPE, bufsize=-1)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise IOError('{} failed with exit code {}'.format(command[0], returncode))
+
+
+def read_rows(source, threads=None):
+    """
+    Rows of the input data without the header, yield (line number, row without newline).
+
+    The source is the input data file, or the output directory of ingest(), read
+    without decompressing the input again: it holds only the valid rows (with \r
+    replaced) of the local indexes of this node, all rows only with one node.
+    """
+    if not path.isdir(source):
+        with open_data(source, threads) as f:
+            for nr, line in enumerate(f, 1):
+                if nr > 1:
+                    yield nr, line.rstrip('\n')
+        return
+    for name in sorted(listdir(source)):
+        if not SHARD_DIRECTORY.match(name):
+            continue
+        directory = path.join(source, name)
+        for part in sorted(listdir(directory)):
+            with open(path.join(directory, part), 'rb') as f:
+                for line in f:
+                    nr, row = line.split('\t', 1)
+                    yield int(nr), row.rsplit('\t', 1)[0]
+
+
+def read_chunks(data, chunk_size):
+    """Chunks of whole lines, yield (line number of the first line, chunk)."""
+    nr = 1
+    tail = ''
+    while True:
+        block = data.read(chunk_size)
+        if not block:
+            break
+        block = tail + block
+        end = block.rfind('\n') + 1
+        if end == 0:
+            tail = block
+            continue
+        chunk, tail = block[:end], block[end:]
+        yield nr, chunk
+        nr += chunk.count('\n')
+    if tail:
+        yield nr, tail
+
+
+def importance_rank(value):
+    """Importance scaled to an integer, 0 for missing or invalid value (as of gawk)."""
+    try:
+        return max(0, int(float(value) * IMPORTANCE_RANK_SCALE + 0.5))
+    except (ValueError, OverflowError):
+        return 0
+
+
+def parse_chunk(nr, chunk, modulo, remainders):
+    """Valid rows of the chunk prefixed by the line number, list of data for each remainder."""
+    shards = dict((remainder, []) for remainder in remainders)
+    lines = chunk.split('\n')
+    if chunk.endswith('\n'):
+        lines.pop()
+    for line in lines:
+        rows = shards.get(nr % modulo)
+        if rows is not None and nr > 1 and line.count('\t') == COLUMN_COUNT - 1:
+            line = line.replace('\r', ' ')
+            rank = importance_rank(line.split('\t', COLUMN_IMPORTANCE + 1)[COLUMN_IMPORTANCE])
+            rows.append('{}\t{}\t{}\n'.format(nr, line, rank))
+        nr += 1
+    return [''.join(shards[remainder]) for remainder in remainders]
+
+
+def split_cpus(cpus):
+    """
+    Split the CPUs between the decompressor and the parsing processes, return (processes, threads).
+
+    The decompressor gets a quarter of the CPUs, one CPU is left to the main process,
+    which reads the decompressed data and hands them over to the parsing processes.
+    """
+    threads = max(1, cpus // 4)
+    return max(1, cpus - threads - 1), threads
+
+
+def chunk_filename(directory, seq):
+    """Chunk of the decompressed data, or part of a shard, named in the input order."""
+    return path.join(directory, '{:08d}.tsv'.format(seq))
+
+
+def write_chunks(data, directory):
+    """Write chunks of whole lines into files, yield (seq, line number of the first line, filename)."""
+    for seq, (nr, chunk) in enumerate(read_chunks(data, CHUNK_SIZE)):
+        filename = chunk_filename(directory, seq)
+        with open(filename, 'wb') as f:
+            f.write(chunk)
+        yield seq, nr, filename
+
+
+def parse_chunk_file(seq, nr, filename, modulo, remainders, directories):
+    """Parse the chunk file (removed then) into the part seq of each shard directory, return (rows, bytes)."""
+    with open(filename, 'rb') as f:
+        chunk = f.read()
+    remove(filename)
+    rows = 0
+    for directory, data in zip(directories, parse_chunk(nr, chunk, modulo, remainders)):
+        with open(chunk_filename(directory, seq), 'wb') as f:
+            f.write(data)
+        rows += data.count('\n')
+    return rows, len(chunk)
+
+
+def ingest(input_filename, output_dir, processes=None, threads=None):
+    """Write the rows of the local indexes of this node, return (rows, decompressed bytes)."""
+    modulo = LOCAL_INDEX_THREADS * NODE_COUNT
+    remainders = [NODE_ID * LOCAL_INDEX_THREADS + i for i in range(LOCAL_INDEX_THREADS)]
+    default_processes, default_threads = split_cpus(cpu_count())
+    processes = processes or default_processes
+    threads = threads or default_threads
+    directories = [shard_directory(output_dir, remainder, modulo) for remainder in remainders]
+    parts = [directory + '.tmp' for directory in directories]
+    # The chunks are handed over through files in the page cache, not pickled through pipes,
+    # and the processes write the parts of the shards themselves
+    chunks_dir = path.join(output_dir, 'chunks.tmp')
+    for directory in parts + [chunks_dir]:
+        if path.isdir(directory):
+            rmtree(directory)
+        makedirs(directory)
+
+    pool = Pool(processes)
+    rows = 0
+    size = 0
+    try:
+        with open_data(input_filename, threads) as data:
+            tasks = ((seq, nr, filename, modulo, remainders, parts)
+                     for seq, nr, filename in write_chunks(data, chunks_dir))
+            for chunk_rows, chunk_size in ordered_map(pool, parse_chunk_file, tasks, 2 * processes):
+                rows += chunk_rows
+                size += chunk_size
+        pool.close()
+    except:
+        pool.terminate()
+        for directory in parts:
+            rmtree(directory, ignore_errors=True)
+        raise
+    finally:
+        pool.join()
+        rmtree(chunks_dir, ignore_errors=True)
+
+    for directory in directories:
+        if path.isdir(directory):
+            rmtree(directory)
+        rename(directory + '.tmp', directory)
+    return rows, size
+
+
+"""
+Main launcher
+"""
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: {} <data.tsv[.gz|.zst]> <output_dir>'.format(sys.argv[0]))
+        sys.exit(1)
+    start = time()
+    rows, size = ingest(sys.argv[1], sys.argv[2])
+    duration = max(time() - start, 1e-9)
+    print('Ingest: {} rows, {:.1f} MB (compressed {:.1f} MB) in {:.1f} seconds, {:.1f} MB/s'.format(
+        rows, size / 2.0 ** 20, path.getsize(sys.argv[1]) / 2.0 ** 20, duration, size / 2.0 ** 20 / duration))
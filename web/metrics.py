@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Prometheus-style metrics for OSMNames-SphinxSearch WebSearch
+#
+# Every process (uwsgi worker) keeps its own counters, gauges and histograms
+# in memory and periodically dumps them as JSON into a shared directory.
+# The /metrics endpoint merges the dumps of all processes, so the output is
+# aggregated across workers.
+#
+# A process holds an exclusive flock on its <pid>-<ms>.lock file while alive.
+# Dumps of finished processes (recycled uwsgi workers) are folded into one
+# compacted file by the next /metrics scrape and removed, their gauges dropped.
+
+from json import dumps, loads
+from os import getenv, getpid, listdir, makedirs, path, rename, unlink
+from time import time
+import errno
+import fcntl
+import threading
+
+
+METRICS_DIR = '/tmp/osmnames-sphinxsearch-metrics'
+if getenv('METRICS_DIR'):
+    METRICS_DIR = getenv('METRICS_DIR')
+
+# Minimal interval between two dumps of process metrics, in seconds
+METRICS_FLUSH_INTERVAL = 1.0
+if getenv('METRICS_FLUSH_INTERVAL'):
+    METRICS_FLUSH_INTERVAL = float(getenv('METRICS_FLUSH_INTERVAL'))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_key(labels):
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in items) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """
+    Process local metrics registry with a shared on-disk aggregation.
+
+    Metric types: counter, gauge, histogram.
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.meta = {}       # name -> (type, help, buckets)
+        self.values = {}     # (name, labels) -> float or [buckets..., sum, count]
+        self.lock = threading.Lock()
+        self.last_flush = 0
+        self.pid = None
+        self.filename = None
+        self.lock_file = None
+
+    def describe(self, name, mtype, help, buckets=None):
+        if mtype == 'histogram' and buckets is None:
+            buckets = DEFAULT_BUCKETS
+        self.meta[name] = (mtype, help, buckets)
+
+    def _process_file(self):
+        # uwsgi forks workers after import, detect the real worker process
+        pid = getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.values = {}
+            base = path.join(self.directory, '{}-{}'.format(pid, int(time() * 1000)))
+            self.filename = base + '.json'
+            # The lock is held until the process exits, the parent's lock file is not ours.
+            # Locked before renamed, so the .lock file is never seen unlocked while alive.
+            self.lock_file = None
+            try:
+                if not path.isdir(self.directory):
+                    makedirs(self.directory)
+                self.lock_file = open(base + '.lock.tmp', 'w')
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                rename(base + '.lock.tmp', base + '.lock')
+            except (IOError, OSError) as ex:
+                print(str(ex))
+        return self.filename
+
+    def inc(self, name, labels=None, value=1):
+        self._process_file()
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        self._process_file()
+        with self.lock:
+            self.values[(name, _labels_key(labels))] = value
+
+    def observe(self, name, value, labels=None):
+        self._process_file()
+        buckets = self.meta[name][2]
+        key = (name, _labels_key(labels))
+        with self.lock:
+            hist = self.values.get(key)
+            if hist is None:
+                hist = [0] * (len(buckets) + 2)
+                self.values[key] = hist
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def flush(self, force=False):
+        """Dump process metrics into the shared directory, at most once per interval."""
+        now = time()
+        if not force and now - self.last_flush < self.flush_interval:
+            return
+        self.last_flush = now
+        filename = self._process_file()
+        with self.lock:
+            data = [[name, list(labels), value]
+                    for (name, labels), value in self.values.items()]
+        try:
+            if not path.isdir(self.directory):
+                makedirs(self.directory)
+            self._write(filename, data)
+        except (IOError, OSError) as ex:
+            print(str(ex))
+
+    def _merge(self, merged, data, gauges=True):
+        for name, labels, value in data:
+            if name not in self.meta:
+                continue
+            mtype = self.meta[name][0]
+            if mtype == 'gauge' and not gauges:
+                continue
+            key = (name, tuple(tuple(l) for l in labels))
+            if mtype == 'histogram':
+                if key not in merged:
+                    merged[key] = [0] * len(value)
+                merged[key] = [a + b for a, b in zip(merged[key], value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+    def _read(self, filename):
+        try:
+            with open(filename) as f:
+                return loads(f.read())
+        except (IOError, OSError, ValueError):
+            return []
+
+    def _finished(self, base):
+        """Process of the dump has finished, its lock file is not locked anymore."""
+        try:
+            with open(base + '.lock', 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+        return True
+
+    def _write(self, filename, data):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(dumps(data))
+        rename(tmp, filename)
+
+    def _collect(self):
+        """Merge metrics of all processes, compact dumps of the finished processes."""
+        try:
+            files = listdir(self.directory)
+        except OSError:
+            return {}
+        bases = set(filename.rsplit('.', 1)[0] for filename in files
+                    if filename[0].isdigit() and filename.endswith(('.json', '.lock')))
+        compacted_file = path.join(self.directory, 'compacted.json')
+        # One scrape at a time compacts, the others wait for it
+        with open(path.join(self.directory, 'compacted.lock'), 'w') as guard:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            compacted = {}
+            self._merge(compacted, self._read(compacted_file), gauges=False)
+            alive = {}
+            finished = []
+            for base in bases:
+                base = path.join(self.directory, base)
+                if self._finished(base):
+                    finished.append(base)
+                    self._merge(compacted, self._read(base + '.json'), gauges=False)
+                else:
+                    self._merge(alive, self._read(base + '.json'))
+            if finished:
+                try:
+                    self._write(compacted_file, [[name, list(labels), value]
+                                                 for (name, labels), value in compacted.items()])
+                    for base in finished:
+                        for ext in ('.json', '.json.tmp', '.lock'):
+                            if path.exists(base + ext):
+                                unlink(base + ext)
+                except (IOError, OSError) as ex:
+                    print(str(ex))
+
+        merged = compacted
+        for key, value in alive.items():
+            if isinstance(value, list):
+                merged[key] = [a + b for a, b in zip(merged.get(key, [0] * len(value)), value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self):
+        """Render merged metrics in the Prometheus text exposition format."""
+        self.flush(force=True)
+        merged = self._collect()
+        lines = []
+        for name in sorted(self.meta):
+            mtype, help, buckets = self.meta[name]
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, mtype))
+            for (mname, labels), value in sorted(merged.items()):
+                if mname != name:
+                    continue
+                if mtype != 'histogram':
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+                    continue
+                for bound, count in zip(buckets, value):
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels, ('le', _format_value(float(bound)))), count))
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels, ('le', '+Inf')), value[-1]))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(value[-2])))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Bounded parallel map of OSMNames-SphinxSearch command line tools
+#
+# Used by ingest.py and reverse_bulk.py to process a large input in a pool of
+# processes in chunks, with the results in the input order and without reading
+# the input ahead into memory (as Pool.imap does).
+
+from collections import deque
+
+
+def ordered_map(pool, func, tasks, in_flight):
+    """
+    Apply func(*args) for the args of tasks in the pool, yield the results in the order of tasks.
+
+    At most in_flight tasks are submitted and not yielded yet, the next args
+    are taken from tasks only when the oldest result is yielded.
+    """
+    pending = deque()
+    for args in tasks:
+        pending.append(pool.apply_async(func, args))
+        while pending and (pending[0].ready() or len(pending) >= in_flight):
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
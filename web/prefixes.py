@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Short prefixes index for autocomplete of OSMNames-SphinxSearch
+#
+# For every prefix (PREFIX_MIN_LEN to PREFIX_MAX_LEN characters) of the words of the names
+# it keeps ids of the top PREFIX_TOP_N places by importance, globally and
+# optionally per country_code. It is built at reindex time:
+#
+#   python prefixes.py /data/ingest /data/index/prefixes.bin [--countries]
+#
+# from the rows of the ingest directory (or from the input data, see
+# ingest.read_rows) and loaded by the WebSearch, which answers the shortest (and most expensive
+# for the prefix/infix indexes) autocomplete queries without searchd: the file
+# holds the attributes of the kept places as well, memory mapped and so shared
+# by the worker processes.
+
+from array import array
+from bisect import bisect_left
+from json import dumps, loads
+from os import path, rename
+from time import time
+import heapq
+import mmap
+import re
+import sys
+import unicodedata
+
+from ingest import COLUMN_IMPORTANCE, COLUMNS, importance_rank, read_rows
+
+
+PREFIXES_MAGIC = 'OSMNAMES-PREFIXES-3\n'
+
+# Minimal length of the indexed prefixes, in characters, min_prefix_len of ind_name_prefix
+# (sphinx.conf): searchd matches a shorter query only as a whole word, so it is left to searchd
+PREFIX_MIN_LEN = 2
+
+# Maximal length of the indexed prefixes, in characters
+PREFIX_MAX_LEN = 3
+
+# Number of places kept for each prefix
+PREFIX_TOP_N = 100
+
+# Float attributes of the attribute store (src_name in sphinx.conf), the other columns are strings
+FLOAT_ATTRS = ['lon', 'lat', 'place_rank', 'importance', 'west', 'south', 'east', 'north']
+
+WORD_SEPARATOR = re.compile(r'\W+', re.UNICODE)
+
+
+def normalize(text):
+    """Lowercase text without diacritics, close to the charset_table of sphinx.conf."""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join(c for c in text if not unicodedata.combining(c))
+
+
+def word_prefixes(names):
+    """Set of prefixes of all words of the names."""
+    prefixes = set()
+    for name in names:
+        for word in WORD_SEPARATOR.split(normalize(name)):
+            for length in range(PREFIX_MIN_LEN, min(len(word), PREFIX_MAX_LEN) + 1):
+                prefixes.add(word[:length])
+    return prefixes
+
+
+def float32(value):
+    """Float attribute as stored by searchd: float32, 0 if invalid."""
+    try:
+        return array('f', [float(value)])[0]
+    except (ValueError, OverflowError):
+        return 0.0
+
+
+def sphinx_float(value):
+    """Float attribute as returned by searchd: float32 printed with 6 decimals, 0 if invalid."""
+    return float('%f' % float32(value))
+
+
+def build(input_filename, output_filename, countries=False):
+    """Collect top places for each prefix and store them into the file."""
+    col_importance = COLUMNS.index('importance')
+    col_country = COLUMNS.index('country_code')
+    # key -> heap of (importance, -id, row)
+    tops = {}
+    for nr, row in read_rows(input_filename):
+        row = row.replace('\r', ' ')
+        cols = row.split('\t')
+        if len(cols) != len(COLUMNS):
+            continue
+        # Same order as of searchd: importance attribute (float32) DESC, id ASC
+        item = (float32(cols[col_importance]), -nr, row)
+        for prefix in word_prefixes(cols[0:2]):
+            keys = [prefix]
+            if countries and cols[col_country]:
+                keys.append(u'{}:{}'.format(cols[col_country].lower(), prefix))
+            for key in keys:
+                heap = tops.get(key)
+                if heap is None:
+                    tops[key] = [item]
+                elif len(heap) < PREFIX_TOP_N:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+    # Sorted keys, ids of each key ordered by importance
+    keys = sorted(tops)
+    offsets = array('i', [0])
+    ids = array('i')
+    rows = {}
+    for key in keys:
+        for importance, nr, row in sorted(tops[key], reverse=True):
+            ids.append(-nr)
+            rows[-nr] = row
+        offsets.append(len(ids))
+
+    # Rows of the kept places, sorted by id
+    doc_ids = array('i', sorted(rows))
+    doc_offsets = array('I', [0])
+    size = 0
+    for i in doc_ids:
+        size += len(rows[i])
+        doc_offsets.append(size)
+
+    blob = u'\n'.join(keys).encode('utf-8')
+    header = {
+        'keys': len(keys),
+        'ids': len(ids),
+        'docs': len(doc_ids),
+        'keys_bytes': len(blob),
+        'min_len': PREFIX_MIN_LEN,
+        'max_len': PREFIX_MAX_LEN,
+        'top_n': PREFIX_TOP_N,
+        'countries': countries,
+    }
+    tmp = output_filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(PREFIXES_MAGIC)
+        f.write(dumps(header) + '\n')
+        f.write(blob)
+        offsets.tofile(f)
+        ids.tofile(f)
+        doc_ids.tofile(f)
+        doc_offsets.tofile(f)
+        for i in doc_ids:
+            f.write(rows[i])
+    rename(tmp, output_filename)
+    return len(keys)
+
+
+class PrefixIndex(object):
+    """Top places for short prefixes and their attributes, loaded from the file built by build()."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = path.getmtime(filename)
+        with open(filename, 'rb') as f:
+            if f.readline() != PREFIXES_MAGIC:
+                raise ValueError('Unknown format of prefixes file {}'.format(filename))
+            header = loads(f.readline())
+            self.min_len = header['min_len']
+            self.max_len = header['max_len']
+            self.top_n = header['top_n']
+            self.countries = header['countries']
+            blob = f.read(header['keys_bytes']).decode('utf-8')
+            keys = blob.split(u'\n') if header['keys'] else []
+            self.offsets = array('i')
+            self.offsets.fromfile(f, header['keys'] + 1)
+            self.ids = array('i')
+            self.ids.fromfile(f, header['ids'])
+            self.doc_ids = array('i')
+            self.doc_ids.fromfile(f, header['docs'])
+            self.doc_offsets = array('I')
+            self.doc_offsets.fromfile(f, header['docs'] + 1)
+            # Rows are read from the page cache on demand
+            self.rows_start = f.tell()
+            self.rows = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.keys = dict((key, i) for i, key in enumerate(keys))
+
+    def lookup(self, query, country_code=None):
+        """
+        Get ids of the most important places with a word starting with query.
+
+        Return list of ids ordered by importance, or None if the query is not covered.
+        """
+        prefix = normalize(query).strip()
+        if len(prefix) < self.min_len or len(prefix) > self.max_len or WORD_SEPARATOR.search(prefix):
+            return None
+        key = prefix
+        if country_code:
+            if not self.countries:
+                return None
+            key = u'{}:{}'.format(country_code.lower(), prefix)
+        i = self.keys.get(key)
+        if i is None:
+            return []
+        return self.ids[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def documents(self, ids):
+        """
+        Get attributes of the places, as from the attribute store index.
+
+        Return list of matches {'weight': 0, 'id', 'attrs': {}} in order of ids.
+        """
+        matches = []
+        for i in ids:
+            j = bisect_left(self.doc_ids, i)
+            if j == len(self.doc_ids) or self.doc_ids[j] != i:
+                continue
+            row = self.rows[self.rows_start + self.doc_offsets[j]:self.rows_start + self.doc_offsets[j + 1]]
+            cols = row.split('\t')
+            attrs = dict(zip(COLUMNS, cols))
+            attrs['importance_rank'] = importance_rank(cols[COLUMN_IMPORTANCE])
+            for attr in FLOAT_ATTRS:
+                attrs[attr] = sphinx_float(attrs[attr])
+            matches.append({'weight': 0, 'id': i, 'attrs': attrs})
+        return matches
+
+
+"""
+Main launcher
+"""
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print('Usage: {} <data.tsv[.gz]|ingest_dir> <prefixes.bin> [--countries]'.format(sys.argv[0]))
+        sys.exit(1)
+    start = time()
+    count = build(sys.argv[1], sys.argv[2], '--countries' in sys.argv[3:])
+    print('Prefixes index: {} prefixes built in {:.1f} seconds'.format(count, time() - start))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Offline bulk reverse geo-coding for OSMNames-SphinxSearch
+#
+# Reads CSV/TSV file with coordinates, reverse geo-codes the rows in a pool of
+# processes (each with its own pooled SphinxQL connection) using the same
+# reverse_search as the REST API, and writes the input rows with the found
+# place in the input order. Progress is checkpointed, so an interrupted run
+# (or a run stopped by a failed SphinxQL query) continues with --resume.
+#
+#   python reverse_bulk.py --lon-col 1 --lat-col 2 input.tsv.gz output.tsv
+
+from multiprocessing import Pool, cpu_count
+from os import path, rename
+from time import time
+import argparse
+import csv
+import gzip
+import json
+import sys
+
+from parallel import ordered_map
+import websearch
+
+
+# Attributes of the found place appended to the input row
+OUTPUT_ATTRS = ['name_en', 'class', 'type', 'osm_type', 'osm_id', 'country_code', 'distance']
+
+# Options of the worker processes, set by init_worker
+OPTIONS = {}
+
+
+def init_worker(options):
+    OPTIONS.update(options)
+
+
+def geocode_chunk(rows):
+    """
+    Reverse geo-code rows of the chunk, return the output rows.
+
+    A failed search fails the whole chunk (IOError), so it is not checkpointed
+    and it is not mistaken for a row without any place.
+    """
+    output = []
+    for row in rows:
+        values = [''] * len(OUTPUT_ATTRS)
+        try:
+            lon = float(row[OPTIONS['lon_col']])
+            lat = float(row[OPTIONS['lat_col']])
+        except (IndexError, ValueError):
+            output.append(row + values)
+            continue
+        if -180.0 <= lon <= 180.0 and -90.0 <= lat <= 90.0:
+            result, distance = websearch.reverse_search(
+                lon, lat, list(OPTIONS['classes']), False, limit=OPTIONS['limit'])
+            if not result['status']:
+                raise IOError('Reverse geo-coding of {} {} failed: {}'.format(
+                    lon, lat, result.get('message', '')))
+            if result['matches']:
+                attrs = result['matches'][0]['attrs']
+                values = [attrs.get(attr, '') for attr in OUTPUT_ATTRS]
+        output.append(row + values)
+    return output
+
+
+def read_chunks(reader, chunk_size, skip):
+    """Group input rows into chunks, skipping already processed rows."""
+    chunk = []
+    for i, row in enumerate(reader):
+        if i < skip:
+            continue
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def open_input(filename):
+    if filename == '-':
+        return sys.stdin
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def write_rows(writer, output, rows):
+    writer.writerows(rows)
+    output.flush()
+    return len(rows)
+
+
+def write_checkpoint(filename, rows, offset):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps({'rows': rows, 'offset': offset}))
+    rename(tmp, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reverse geo-code CSV/TSV file of coordinates.')
+    parser.add_argument('input', help='input file (.gz supported, - for stdin)')
+    parser.add_argument('output', help='output file')
+    parser.add_argument('--lon-col', type=int, default=0, help='column of longitude (default 0)')
+    parser.add_argument('--lat-col', type=int, default=1, help='column of latitude (default 1)')
+    parser.add_argument('--delimiter', default='\t', help='column delimiter (default tab)')
+    parser.add_argument('--header', action='store_true', help='input has a header row')
+    parser.add_argument('--classes', default='', help='comma separated classes to filter')
+    parser.add_argument('--exact', action='store_true',
+                        help='write the exact nearest place (as ?limit=1), not the nearest one of the smallest bbox')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes (default CPU count)')
+    parser.add_argument('--chunk-size', type=int, default=500, help='rows per task (default 500)')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint file (default <output>.checkpoint)')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint')
+    args = parser.parse_args()
+
+    options = {
+        'lon_col': args.lon_col,
+        'lat_col': args.lat_col,
+        'classes': [cl for cl in args.classes.split(',') if cl],
+        'limit': 1 if args.exact else None,
+    }
+    checkpoint = args.checkpoint or args.output + '.checkpoint'
+
+    # Resume: skip processed input rows, drop output written after the checkpoint
+    done = 0
+    offset = 0
+    if args.resume and path.isfile(checkpoint):
+        with open(checkpoint) as f:
+            state = json.loads(f.read())
+        done, offset = state['rows'], state['offset']
+        output = open(args.output, 'r+b')
+        output.seek(offset)
+        output.truncate()
+    else:
+        output = open(args.output, 'wb')
+
+    source = open_input(args.input)
+    reader = csv.reader(source, delimiter=args.delimiter)
+    writer = csv.writer(output, delimiter=args.delimiter, lineterminator='\n')
+    if args.header:
+        header = next(reader)
+        if offset == 0:
+            writer.writerow(header + OUTPUT_ATTRS)
+
+    processes = args.processes or cpu_count()
+    pool = Pool(processes, init_worker, (options,))
+    start = time()
+    last_report = start
+    processed = 0
+    try:
+        tasks = ((chunk,) for chunk in read_chunks(reader, args.chunk_size, done))
+        for rows in ordered_map(pool, geocode_chunk, tasks, 2 * processes):
+            processed += write_rows(writer, output, rows)
+            write_checkpoint(checkpoint, done + processed, output.tell())
+            now = time()
+            if now - last_report >= 5:
+                last_report = now
+                sys.stderr.write('{} rows, {:.0f} rows/s\n'.format(
+                    done + processed, processed / (now - start)))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.stderr.write('Interrupted, continue with --resume\n')
+        sys.exit(1)
+    except IOError as ex:
+        pool.terminate()
+        sys.stderr.write('Failed after {} rows: {}\nContinue with --resume\n'.format(done + processed, ex))
+        sys.exit(1)
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        output.close()
+
+    duration = max(time() - start, 1e-9)
+    sys.stderr.write('Finished: {} rows in {:.1f} seconds, {:.0f} rows/s\n'.format(
+        done + processed, duration, processed / duration))
+
+
+"""
+Main launcher
+"""
+if __name__ == '__main__':
+    main()
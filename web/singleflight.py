@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Single-flight coalescing of identical concurrent requests
+#
+# The first request for a key (the leader) runs the work, the identical
+# requests arriving while it is in flight wait for it and share its value.
+# Works with threads and with gevent (monkey patched threading).
+
+import threading
+
+
+class SingleFlightTimeout(Exception):
+    """Waiting for the in-flight leader request took too long."""
+    pass
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Group of in-flight calls identified by a hashable key."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, timeout=None):
+        """
+        Run fn() once for all concurrent callers with the same key.
+
+        Return (value, shared), shared is True if value was computed by other caller.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if not leader:
+            if timeout is not None and timeout <= 0:
+                raise SingleFlightTimeout()
+            if not call.event.wait(timeout):
+                raise SingleFlightTimeout()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value = fn()
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.value, False
@@ -9,19 +9,32 @@
 # Author: Martin Mikita (martin.mikita @ klokantech.com)
 # Date: 15.07.2016
 
-from flask import Flask, request, Response, render_template, url_for, redirect
+from flask import Flask, request, Response, render_template, url_for, redirect, g
 from pprint import pprint, PrettyPrinter
 from json import dumps
-from os import getenv, path, utime
+from os import getenv, getpid, makedirs, path, utime
 from time import time, mktime
 from datetime import datetime
 import sys
 import MySQLdb
+from MySQLdb.constants import CLIENT
 import re
 import natsort
 import rfc822   # Used for parsing RFC822 into datetime
 import email    # Used for formatting TS into RFC822
 import traceback
+import logging
+import logging.handlers
+import cProfile
+import random
+import math
+import threading
+from metrics import Metrics
+from admission import AdmissionControl
+from singleflight import SingleFlightTimeout
+from dbpool import BalancedPool, PoolTimeout
+from areas import AreaIndex
+from prefixes import PrefixIndex
 
 
 # Prepare global variables
@@ -32,6 +45,12 @@ if getenv('SEARCH_MAX_COUNT'):
 if getenv('SEARCH_DEFAULT_COUNT'):
     SEARCH_DEFAULT_COUNT = int(getenv('SEARCH_DEFAULT_COUNT'))
 
+# Maximum number of statements in one SphinxQL batch (searchd max_batch_queries)
+MAX_BATCH_QUERIES = 32
+
+# The only index with all attributes, see sphinx.conf
+ATTRIBUTE_STORE_INDEX = 'ind_name_exact'
+
 TMPFILE_DATA_TIMESTAMP = "/tmp/osmnames-sphinxsearch-data.timestamp"
 
 NOCACHEREDIRECT = False
@@ -47,6 +66,57 @@ except OSError:
     mtime = time()
 DATA_LAST_MODIFIED = email.utils.formatdate(mtime, usegmt=True)
 
+# Cache results for 4 hours in Web Browsers and 12 hours in CDN caches
+CACHE_CONTROL = 'public, max-age=14400, s-maxage=43200'
+
+# Requests slower than threshold (in seconds) are written into the slow log, 0 disables it
+SLOW_REQUEST_THRESHOLD = 1.0
+if getenv('SLOW_REQUEST_THRESHOLD'):
+    SLOW_REQUEST_THRESHOLD = float(getenv('SLOW_REQUEST_THRESHOLD'))
+SLOW_REQUEST_LOG = '/var/log/websearch/slow-requests.log'
+if getenv('SLOW_REQUEST_LOG'):
+    SLOW_REQUEST_LOG = getenv('SLOW_REQUEST_LOG')
+
+# Profile 1 in PROFILE_SAMPLE_RATE requests, 0 disables the profiler
+PROFILE_SAMPLE_RATE = 0
+if getenv('PROFILE_SAMPLE_RATE'):
+    PROFILE_SAMPLE_RATE = int(getenv('PROFILE_SAMPLE_RATE'))
+PROFILE_DIR = '/tmp/osmnames-sphinxsearch-profiles'
+if getenv('PROFILE_DIR'):
+    PROFILE_DIR = getenv('PROFILE_DIR')
+# The profiler hooks the whole thread, at most one request of the process is profiled at a time
+PROFILER_LOCK = threading.Lock()
+
+# Time budget of a request (in seconds), can be overridden per route
+REQUEST_DEADLINE = 5.0
+if getenv('REQUEST_DEADLINE'):
+    REQUEST_DEADLINE = float(getenv('REQUEST_DEADLINE'))
+# dict[ route ] = deadline
+ROUTE_DEADLINES = {}
+if getenv('REQUEST_DEADLINE_REVERSE'):
+    ROUTE_DEADLINES['/r/'] = float(getenv('REQUEST_DEADLINE_REVERSE'))
+if getenv('REQUEST_DEADLINE_BBOX'):
+    ROUTE_DEADLINES['/bbox/'] = float(getenv('REQUEST_DEADLINE_BBOX'))
+if getenv('REQUEST_DEADLINE_SEARCH'):
+    ROUTE_DEADLINES['/q/'] = float(getenv('REQUEST_DEADLINE_SEARCH'))
+
+# Containing areas index, built by sphinx-reindex.sh
+AREAS_FILE = '/data/index/areas.bin'
+if getenv('AREAS_FILE'):
+    AREAS_FILE = getenv('AREAS_FILE')
+# Short prefixes index for autocomplete, built by sphinx-reindex.sh
+PREFIXES_FILE = '/data/index/prefixes.bin'
+if getenv('PREFIXES_FILE'):
+    PREFIXES_FILE = getenv('PREFIXES_FILE')
+# Interval between two checks for the rebuilt in-memory indexes, in seconds
+MEMORY_INDEX_CHECK_INTERVAL = 60
+# In-memory indexes
+# dict[ name ] = [class, filename, index, last check]
+MEMORY_INDEXES = {
+    'areas': [AreaIndex, AREAS_FILE, None, 0],
+    'prefixes': [PrefixIndex, PREFIXES_FILE, None, 0],
+}
+
 # Filter attributes values
 # dict[ attribute ] = list(values)
 CHECK_ATTR_FILTER = ['country_code', 'class']
@@ -56,10 +126,87 @@ ATTR_VALUES = {}
 app = Flask(__name__, template_folder='templates/')
 app.debug = not (getenv('WEBSEARCH_DEBUG') is None)
 
+# Request metrics, aggregated across all worker processes
+METRICS = Metrics()
+METRICS.describe('websearch_requests_total', 'counter',
+                 'Number of handled requests.')
+METRICS.describe('websearch_request_duration_seconds', 'histogram',
+                 'Total time spent handling the request.')
+METRICS.describe('websearch_stage_duration_seconds', 'histogram',
+                 'Time spent in a stage of the request (connect, query, merge, serialize).')
+METRICS.describe('websearch_sphinxql_query_duration_seconds', 'histogram',
+                 'Duration of a single SphinxQL round trip.')
+METRICS.describe('websearch_sphinxql_queries_total', 'counter',
+                 'Number of SphinxQL round trips.')
+METRICS.describe('websearch_bbox_iterations', 'histogram',
+                 'Number of bounding box expansions of the reverse search.',
+                 buckets=(1, 2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 30))
+METRICS.describe('websearch_slow_requests_total', 'counter',
+                 'Number of requests slower than the slow request threshold.')
+METRICS.describe('websearch_deadline_exceeded_total', 'counter',
+                 'Number of requests which exceeded their deadline.')
+METRICS.describe('websearch_admission_in_flight', 'gauge',
+                 'Number of requests running SphinxQL queries.')
+METRICS.describe('websearch_admission_queue_depth', 'gauge',
+                 'Number of requests waiting for a free SphinxQL slot.')
+METRICS.describe('websearch_admission_rejected_total', 'counter',
+                 'Number of requests shed by the admission control.')
+METRICS.describe('websearch_admission_wait_seconds', 'histogram',
+                 'Time spent waiting for a free SphinxQL slot.')
+METRICS.describe('websearch_sphinxql_endpoint_in_flight', 'gauge',
+                 'Number of SphinxQL connections in use per endpoint.')
+METRICS.describe('websearch_sphinxql_endpoint_up', 'gauge',
+                 'Number of workers, which consider the SphinxQL endpoint healthy.')
+METRICS.describe('websearch_prefixes_index_hits_total', 'counter',
+                 'Number of searches answered by the in-memory prefixes index.')
+METRICS.describe('websearch_coalesced_requests_total', 'counter',
+                 'Number of requests served by the response of an identical in-flight request.')
+
+# Concurrency limit and queue of SphinxQL work, shared by all workers,
+# created on the first request (see get_admission), or set by websearch_gevent.py
+ADMISSION = None
+
+# Identical in-flight requests of the process share one response, set by
+# websearch_gevent.py: a sync uwsgi worker serves one request at a time
+SINGLE_FLIGHT = None
+
+
+# ---------------------------------------------------------
+def get_slow_logger():
+    """Log of slow requests, one JSON object per line, rotated by logrotate."""
+    logger = logging.getLogger('websearch.slow')
+    if logger.handlers:
+        return logger
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    try:
+        if not path.isdir(path.dirname(SLOW_REQUEST_LOG)):
+            makedirs(path.dirname(SLOW_REQUEST_LOG))
+        # All workers append into one file, reopened after it is rotated (conf/logrotate)
+        handler = logging.handlers.WatchedFileHandler(SLOW_REQUEST_LOG)
+    except (IOError, OSError) as ex:
+        print(str(ex))
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    return logger
+
 
 # ---------------------------------------------------------
-def get_db_cursor():
+def db_connect(host, port):
     # connect to the mysql server
+    # multi-statements allow to send more queries in one round trip
+    return MySQLdb.connect(host=host, port=port, user='root',
+                           client_flag=CLIENT.MULTI_STATEMENTS)
+
+
+def get_db_servers():
+    """
+    Get SphinxQL endpoints as list of (host, port).
+
+    WEBSEARCH_SERVERS is comma separated list of host:port,
+    otherwise single WEBSEARCH_SERVER and WEBSEARCH_SERVER_PORT are used.
+    """
     # default server configuration
     host = '127.0.0.1'
     port = 9306
@@ -67,12 +214,62 @@ def get_db_cursor():
         host = getenv('WEBSEARCH_SERVER')
     if getenv('WEBSEARCH_SERVER_PORT'):
         port = int(getenv('WEBSEARCH_SERVER_PORT'))
+    if not getenv('WEBSEARCH_SERVERS'):
+        return [(host, port)]
+
+    servers = []
+    for server in getenv('WEBSEARCH_SERVERS').split(','):
+        server = server.strip()
+        if not server:
+            continue
+        if ':' in server:
+            server_host, server_port = server.rsplit(':', 1)
+            servers.append((server_host, int(server_port)))
+        else:
+            servers.append((server, port))
+    return servers
+
+
+# Connections (in use and idle) of each process per endpoint, shared by all its (green)threads
+DB_POOL_SIZE = 1
+if getenv('DB_POOL_SIZE'):
+    DB_POOL_SIZE = int(getenv('DB_POOL_SIZE'))
+# Endpoint failing to connect is skipped for DB_SERVER_RETRY seconds
+DB_SERVER_RETRY = 5.0
+if getenv('DB_SERVER_RETRY'):
+    DB_SERVER_RETRY = float(getenv('DB_SERVER_RETRY'))
+DB_POOL = BalancedPool(get_db_servers(), db_connect, DB_POOL_SIZE, DB_SERVER_RETRY)
 
-    db = MySQLdb.connect(host=host, port=port, user='root')
+
+def get_db_cursor(deadline=None):
+    """
+    Get pooled connection and its cursor, db.close() returns the connection into the pool.
+
+    Raise PoolTimeout if all connections are still in use at the deadline.
+    """
+    db = DB_POOL.get(deadline)
     cursor = db.cursor()
     return db, cursor
 
 
+def get_match(desc, row):
+    """Convert SQL row into match {'weight': 0, 'id', 'attrs': {}}."""
+    match = {
+        'weight': 0,
+        'attrs': {},
+        'id': 0,
+    }
+    for (name, value) in zip(desc, row):
+        col = name[0]
+        if col == 'id':
+            match['id'] = value
+        elif col == 'weight':
+            match['weight'] = value
+        else:
+            match['attrs'][col] = value
+    return match
+
+
 def get_query_result(cursor, sql, args):
     """
     Get result from SQL Query.
@@ -92,20 +289,7 @@ def get_query_result(cursor, sql, args):
         matches = []
         status = True
         for row in cursor:
-            match = {
-                'weight': 0,
-                'attrs': {},
-                'id': 0,
-            }
-            for (name, value) in zip(desc, row):
-                col = name[0]
-                if col == 'id':
-                    match['id'] = value
-                elif col == 'weight':
-                    match['weight'] = value
-                else:
-                    match['attrs'][col] = value
-            matches.append(match)
+            matches.append(get_match(desc, row))
         # ~ for row in cursor
         result['matches'] = matches
 
@@ -113,12 +297,114 @@ def get_query_result(cursor, sql, args):
         for row in cursor:
             result['total_found'] = int(row[1])
     except Exception as ex:
+        status = False
         result['message'] = str(ex)
+        result['connection_error'] = is_connection_error(ex)
 
     result['status'] = status
     return status, result
 
 
+def get_batch_query_result(cursor, sqls, meta=False):
+    """
+    Get results from more SQL Queries, sent in one round trip (multi-statement).
+
+    With meta, SHOW META follows every query, the warning of a query (e.g. stopped
+    by max_query_time, with incomplete matches) is kept in its result.
+
+    Boolean, [{'matches': [{'weight': 0, 'id', 'attrs': {}}], 'total_found': 0}]
+    """
+    status = True
+    results = []
+    # searchd accepts at most max_batch_queries statements at once
+    step = MAX_BATCH_QUERIES // 2 if meta else MAX_BATCH_QUERIES
+    for i in range(0, len(sqls), step):
+        batch = sqls[i:i + step]
+        if meta:
+            batch = [statement for sql in batch for statement in (sql, 'SHOW META')]
+        try:
+            cursor.execute(';\n'.join(batch))
+            meta_next = False
+            while True:
+                desc = cursor.description
+                rows = cursor.fetchall()
+                if meta_next:
+                    for row in rows:
+                        if row[0] == 'warning' and row[1]:
+                            results[-1]['warning'] = row[1]
+                else:
+                    matches = [get_match(desc, row) for row in rows]
+                    results.append({
+                        'matches': matches,
+                        'status': True,
+                        'total_found': len(matches),
+                    })
+                meta_next = meta and not meta_next
+                if not cursor.nextset():
+                    break
+        except Exception as ex:
+            status = False
+            results.append({
+                'matches': [],
+                'status': False,
+                'total_found': 0,
+                'message': str(ex),
+                'connection_error': is_connection_error(ex),
+            })
+            break
+    return status, results
+
+
+def is_connection_error(ex):
+    """Client error of a lost or refused connection (CR_* codes), not of the query itself."""
+    if isinstance(ex, MySQLdb.InterfaceError):
+        return True
+    return isinstance(ex, MySQLdb.OperationalError) and bool(ex.args) and ex.args[0] >= 2000
+
+
+def query_with_failover(db, cursor, query, deadline=None):
+    """
+    Run query(cursor), which returns (status, result or list of results, ...).
+
+    If the query lost its connection, the endpoint is marked down and the query
+    is retried once on the next endpoint.
+
+    db, cursor (to close or discard), return value of query
+    """
+    value = query(cursor)
+    failed = value[1][-1] if isinstance(value[1], list) else value[1]
+    if value[0] or not failed.get('connection_error'):
+        return db, cursor, value
+    try:
+        db = DB_POOL.failover(db, failed['message'], deadline)
+    except Exception as ex:
+        print(str(ex))
+        return db, cursor, value
+    cursor = db.cursor()
+    return db, cursor, query(cursor)
+
+
+def get_attributes_by_id(cursor, ids, deadline=None):
+    """
+    Get all attributes of documents by id from the attribute store index.
+
+    Full text indexes carry only the fields and the ranking/filter attributes.
+
+    Boolean, {'matches': [{'weight': 0, 'id', 'attrs': {}}] in order of ids, 'total_found': 0}, SQL
+    """
+    sql = "SELECT * FROM {} WHERE id IN ({}) LIMIT {}".format(
+        ATTRIBUTE_STORE_INDEX, ', '.join(str(int(i)) for i in ids), len(ids))
+    if deadline is not None:
+        sql += " OPTION max_query_time={}".format(max(1, int((deadline - time()) * 1000)))
+    status, results = get_batch_query_result(cursor, [sql])
+    result = results[0]
+    if status:
+        matches = dict((match['id'], match) for match in result['matches'])
+        result['matches'] = [matches[i] for i in ids if i in matches]
+        result['total_found'] = len(result['matches'])
+    return status, result, sql
+
+
 # ---------------------------------------------------------
 def get_attributes_values(index, attributes):
     """
@@ -164,7 +450,7 @@ def get_attributes_values(index, attributes):
             if found == 0:
                 del(ATTR_VALUES[attr])
         except Exception as ex:
-            db.close()
+            db.discard()
             print(str(ex))
             return False
 
@@ -172,6 +458,23 @@ def get_attributes_values(index, attributes):
     return True
 
 
+# ---------------------------------------------------------
+def get_memory_index(name):
+    """Get in-memory index (areas, prefixes), loaded again after reindex."""
+    item = MEMORY_INDEXES[name]
+    index_class, filename, index, checked = item
+
+    if time() - checked < MEMORY_INDEX_CHECK_INTERVAL:
+        return index
+    item[3] = time()
+    try:
+        if index is None or index.mtime != path.getmtime(filename):
+            item[2] = index_class(filename)
+    except (IOError, OSError, ValueError) as ex:
+        print(str(ex))
+    return item[2]
+
+
 # ---------------------------------------------------------
 def mergeResultObject(result_old, result_new):
     """
@@ -235,6 +538,8 @@ def prepareResultJson(result):
     }
     if 'message' in result and result['message']:
         response['message'] = result['message']
+    if result.get('timed_out'):
+        response['timed_out'] = True
 
     for row in result['matches']:
         r = row['attrs']
@@ -352,7 +657,9 @@ def formatResponse(data, code=200):
             data['route'] = '/'
         return render_template(tpl, rc=(code == 200), **data), code
 
+    start = time()
     json = dumps(result)
+    g.timings['serialize'] = time() - start
     mime = 'application/json'
     # Append callback for JavaScript
     if request.args.get('json_callback'):
@@ -367,11 +674,57 @@ def formatResponse(data, code=200):
         mime = 'application/javascript'
     resp = Response(json, mimetype=mime)
     resp.headers['Access-Control-Allow-Origin'] = '*'
-    # Cache results for 4 hours in Web Browsers and 12 hours in CDN caches
-    resp.headers['Cache-Control'] = 'public, max-age=14400, s-maxage=43200'
+    # Partial results of the exceeded deadline and error messages must not stay in caches
+    if isinstance(result, dict) and (result.get('timed_out') or result.get('message')):
+        resp.headers['Cache-Control'] = 'no-cache'
+    else:
+        resp.headers['Cache-Control'] = CACHE_CONTROL
     resp.headers['Last-Modified'] = DATA_LAST_MODIFIED
     return resp, code
 
+
+def serviceUnavailableResponse(data):
+    """Format 503 response for request, which exceeded its deadline or was shed."""
+    resp, code = formatResponse(data, 503)
+    resp.headers['Retry-After'] = '1'
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp, code
+
+
+def get_admission():
+    """Get the admission control, create the shared one on the first use."""
+    global ADMISSION
+    if ADMISSION is None:
+        ADMISSION = AdmissionControl()
+    return ADMISSION
+
+
+def admit_request(route, deadline):
+    """Get admission slot for SphinxQL work of the route, None if shed."""
+    def on_queue(delta):
+        METRICS.inc('websearch_admission_queue_depth', value=delta)
+
+    start = time()
+    slot = get_admission().acquire(deadline, on_queue)
+    METRICS.observe('websearch_admission_wait_seconds', time() - start, {'route': route})
+    if slot is None:
+        METRICS.inc('websearch_admission_rejected_total', {'route': route})
+        return None
+    METRICS.inc('websearch_admission_in_flight', value=1)
+    return slot
+
+
+def release_request(slot):
+    """Release admission slot of the request."""
+    get_admission().release(slot)
+    METRICS.inc('websearch_admission_in_flight', value=-1)
+
+
+def get_route_deadline(route):
+    """Get time budget for the route, in seconds."""
+    return ROUTE_DEADLINES.get(route, REQUEST_DEADLINE)
+
+
 class MyPrettyPrinter(PrettyPrinter):
     def format(self, object, context, maxlevels, level):
         if isinstance(object, unicode):
@@ -409,19 +762,58 @@ Date:   11.07.2017
 """
 
 
+# Earth radius used by the SphinxQL GEODIST function, in meters
+GEODIST_EARTH_RADIUS = 6384000.0
+
+
+# reverse_search_radius - radius around the point, which lies completely inside the bounding box
+# lat     - float   - the latitude coordinate, in degrees, of the point
+# delta   - float   - the half size of the bounding box, in degrees
+# lat_min - float   - the bounded minimal latitude of the bounding box
+# lat_max - float   - the bounded maximal latitude of the bounding box
+# returns - radius in meters, all places closer than radius are inside the bounding box
+def reverse_search_radius(lat, delta, lat_min, lat_max):
+    radius = float('inf')
+    # distance to the south/north border along the meridian (no border at the pole)
+    if lat_min > -90.0 or lat_max < 90.0:
+        radius = GEODIST_EARTH_RADIUS * math.radians(delta)
+    # distance to the great circle of the west/east border meridian
+    if delta < 180.0:
+        lon_radius = GEODIST_EARTH_RADIUS * math.asin(
+            math.cos(math.radians(lat)) * math.sin(math.radians(delta)))
+        radius = min(radius, lon_radius)
+    # keep a margin for the GEODIST approximation
+    return radius * 0.99
+
+
 # reverse_search - find the closest place in the data set to the supplied coordinates
 # lon     - float   - the longitude coordinate, in degrees, for the closest place match
 # lat     - float   - the latitude coordinate, in degrees, for the closest place match
 # classes - array   - the array of classes to filter, empty array without filtering
 # debug   - boolean - if true, include diagnostics in the result
+# deadline - float  - absolute time (as time()) when the search has to stop, None without limit
+# limit   - int     - the number of the nearest places, sorted by distance,
+#                     None for the single place found in the smallest bounding box
 # returns - result, distance tuple
-def reverse_search(lon, lat, classes, debug):
+def reverse_search(lon, lat, classes, debug, deadline=None, limit=None):
     result = {
         'total_found': 0,
         'count': 0,
-        'matches': []
+        'matches': [],
+        'timed_out': False,
     }
 
+    # Timing breakdown of the request, in seconds
+    timings = {
+        'connect': 0.0,
+        'queries': [],
+        'iterations': 0,
+        'merge': 0.0,
+    }
+    result['timings'] = timings
+    # Executed SphinxQL queries, kept for the slow request log
+    result['queries'] = []
+
     if debug:
         result['debug'] = {
             'longitude': lon,
@@ -430,23 +822,46 @@ def reverse_search(lon, lat, classes, debug):
             'results': [],
         }
 
+    start = time()
     try:
-        db, cursor = get_db_cursor()
+        db, cursor = get_db_cursor(deadline)
+    except PoolTimeout as ex:
+        result['timed_out'] = True
+        result['message'] = str(ex)
+        return result, 0
     except Exception as ex:
         status = False
         result['message'] = str(ex)
         result['status'] = status
         return result, 0
+    timings['connect'] = time() - start
 
     # We attempt to find rows using a small bounding box to
     # limit the impact of the distance calculation.
     # If no rows are found with the current bounding box
-    # we double it and try again, until a result is returned.
+    # we double it and try again, until a result is returned,
+    # the bounding box covers the whole world or the deadline is exceeded.
+    # With the limit, we continue until limit rows are found within
+    # the radius, which is completely covered by the bounding box.
+    # All queries of one bounding box are sent in one round trip.
 
     delta = 0.0004
-    count = 0
+    matches = []
+    timed_out = False
+    count = limit or 1
+
+    if not classes:
+        classes = [""]
+
+    while not timed_out and delta < 360.0:
+        if deadline is not None:
+            # Stop with the best result found so far
+            remaining = deadline - time()
+            if remaining <= 0:
+                timed_out = True
+                break
 
-    while count == 0:
+        timings['iterations'] += 1
         delta *= 2
         lon_min = lon - delta
         lon_max = lon + delta
@@ -477,54 +892,190 @@ def reverse_search(lon, lat, classes, debug):
             wherelon.append("lon BETWEEN {} AND {}".format(lon_min, lon_max))
         # latitude condition is the same for all cases
         wherelat = "lat BETWEEN {} AND {}".format(lat_min, lat_max)
-        # limit the result set to the single closest match
-        limit = " ORDER BY distance ASC LIMIT 1"
-
-        myresult = {}
-        if not classes:
-            classes = [""]
-        # form the final queries and execute
+        # limit the result set to the closest matches
+        order = " ORDER BY distance ASC LIMIT {}".format(count)
+        if deadline is not None:
+            # searchd stops the query processing after the remaining time
+            order += " OPTION max_query_time={}".format(max(1, int(remaining * 1000)))
+
+        # form the final queries and execute them in one batch
+        sqls = []
         for where in wherelon:
             for cl in classes:
                 sql = select + " AND ".join([where, wherelat])
                 if cl:
-                    sql += " AND class='{}' ".format(cl)
-                sql += limit
-                # Boolean, {'matches': [{'weight': 0, 'id', 'attrs': {}}], 'total_found': 0}
-                status, result_new = get_query_result(cursor, sql, ())
-                if debug:
-                    result['debug']['queries'].append(sql)
-                    result['debug']['results'].append(result_new)
-                if 'matches' in myresult and len(myresult['matches']) > 0:
-                    myresult = mergeResultObject(myresult, result_new)
-                else:
-                    myresult = result_new.copy()
+                    sql += " AND class='{}' ".format(cl.replace('\\', '\\\\').replace("'", "\\'"))
+                sql += order
+                sqls.append(sql)
+
+        # Boolean, [{'matches': [{'weight': 0, 'id', 'attrs': {}}], 'total_found': 0}]
+        start = time()
+        db, cursor, (status, results_new) = query_with_failover(
+            db, cursor, lambda cursor: get_batch_query_result(cursor, sqls, meta=True), deadline)
+        timings['queries'].append(time() - start)
+        result['queries'].extend(sqls)
+        if debug:
+            result['debug']['queries'].extend(sqls)
+            result['debug']['results'].extend(results_new)
+        if not status:
+            # The places of this bounding box are unknown, a farther place would be wrong
+            db.discard()
+            result['message'] = results_new[-1]['message']
+            result['status'] = False
+            return result, None
+
+        # Order the rows returned by the calculated distance
+        # (the 180 meridian case and the class filter result in more queries to merge)
+        start = time()
+        unique_ids = set()
+        matches = []
+        for result_new in results_new:
+            for match in result_new['matches']:
+                if match['id'] not in unique_ids:
+                    unique_ids.add(match['id'])
+                    matches.append(match)
+        matches.sort(key=lambda match: match['attrs']['distance'])
+        matches = matches[:count]
+        timings['merge'] += time() - start
+
+        # A query stopped by max_query_time did not check all places of the bounding box,
+        # a nearer place may be missing
+        warnings = [result_new['warning'] for result_new in results_new if 'warning' in result_new]
+        if warnings:
+            print('Incomplete reverse search result: {}'.format(warnings[0]))
+            timed_out = True
+            break
 
-        count = len(myresult['matches'])
+        if limit is None:
+            if matches:
+                break
+        elif len(matches) >= limit and \
+                matches[-1]['attrs']['distance'] <= reverse_search_radius(lat, delta, lat_min, lat_max):
+            break
     db.close()
 
     if debug:
-        result['debug']['matches'] = myresult['matches']
+        result['debug']['matches'] = matches
+
+    result['timed_out'] = timed_out
+    result['start_index'] = 1
+    result['status'] = True
+    result['count'] = len(matches)
+    result['matches'] = matches
+    result['total_found'] = len(matches)
+    if not matches:
+        return result, None
+    if timed_out:
+        result['message'] = 'Request deadline exceeded, returning the best result found so far.'
+    return result, matches[0]['attrs']['distance']
 
-    smallest_row = None
-    smallest_distance = None
 
-    # For the rows returned, find the smallest calculated distance
-    # (the 180 meridian case may result in 2 rows to check)
-    for match in myresult['matches']:
-        distance = match['attrs']['distance']
+# contains_search - find the areas containing the supplied coordinates, using the areas index
+# lon     - float   - the longitude coordinate, in degrees
+# lat     - float   - the latitude coordinate, in degrees
+# classes - array   - the array of classes to filter, empty array without filtering
+# debug   - boolean - if true, include diagnostics in the result
+# deadline - float  - absolute time (as time()) when the search has to stop, None without limit
+# limit   - int     - the maximal number of areas, None for SEARCH_DEFAULT_COUNT
+# returns - result, distance tuple, distance is always None
+def contains_search(lon, lat, classes, debug, deadline=None, limit=None):
+    result = {
+        'total_found': 0,
+        'count': 0,
+        'start_index': 1,
+        'matches': [],
+        'timed_out': False,
+        'status': False,
+        'timings': {
+            'connect': 0.0,
+            'queries': [],
+            'iterations': 0,
+            'merge': 0.0,
+        },
+        'queries': [],
+    }
+    timings = result['timings']
+    if debug:
+        result['debug'] = {
+            'longitude': lon,
+            'latitude': lat,
+            'queries': [],
+            'results': [],
+        }
 
-        if smallest_row is None or distance < smallest_distance:
-            smallest_row = match
-            smallest_distance = distance
+    areas = get_memory_index('areas')
+    if areas is None:
+        result['message'] = 'Containing areas index is not available.'
+        return result, None
 
-    result = mergeResultObject(result, myresult)
-    result['count'] = 1
-    result['matches'] = [smallest_row]
-    result['start_index'] = 1
+    # The areas ordered by place_rank, the smallest first
+    start = time()
+    found = areas.contains(lon, lat, classes)[:limit or SEARCH_DEFAULT_COUNT]
+    timings['merge'] = time() - start
+    if debug:
+        result['debug']['areas'] = found
     result['status'] = True
-    result['total_found'] = 1
-    return result, smallest_distance
+    if not found:
+        return result, None
+
+    # Fetch the attributes of the areas by id
+    start = time()
+    try:
+        db, cursor = get_db_cursor(deadline)
+    except PoolTimeout as ex:
+        result['status'] = False
+        result['timed_out'] = True
+        result['message'] = str(ex)
+        return result, None
+    except Exception as ex:
+        result['status'] = False
+        result['message'] = str(ex)
+        return result, None
+    timings['connect'] = time() - start
+
+    start = time()
+    db, cursor, (status, result_new, sql) = query_with_failover(
+        db, cursor, lambda cursor: get_attributes_by_id(cursor, [area[0] for area in found], deadline), deadline)
+    timings['queries'].append(time() - start)
+    result['queries'].append(sql)
+    if debug:
+        result['debug']['queries'].append(sql)
+        result['debug']['results'].append(result_new)
+    if status:
+        db.close()
+    else:
+        db.discard()
+        result['status'] = False
+        result['message'] = result_new['message']
+        return result, None
+
+    result['matches'] = result_new['matches']
+    result['count'] = len(result['matches'])
+    result['total_found'] = len(result['matches'])
+    return result, None
+
+
+def reverse_search_prepared(lon, lat, classes, debug, deadline, limit=None, mode=None):
+    """
+    Run reverse_search (or contains_search) under admission control and prepare its JSON result.
+
+    code, JSON result, result, distance
+    """
+    slot = admit_request('/r/', deadline)
+    if slot is None:
+        return 503, {'message': 'Service overloaded, try again later.'}, None, None
+    try:
+        search = contains_search if mode == 'contains' else reverse_search
+        result, distance = search(lon, lat, classes, debug, deadline, limit)
+    finally:
+        release_request(slot)
+    g.search_timings = result['timings']
+    g.search_queries = result['queries']
+    if result['timed_out']:
+        METRICS.inc('websearch_deadline_exceeded_total', {'route': '/r/'})
+        if not result['matches']:
+            return 503, {'message': 'Request deadline exceeded, try again later.'}, result, distance
+    return 200, prepareResultJson(result), result, distance
 
 
 # ---------------------------------------------------------
@@ -535,12 +1086,10 @@ def reverse_search_url(lon, lat, classes):
     code = 400
     data = {'format': 'json'}
     debug = request.args.get('debug')
-    times = {}
+    times = g.timings
+    g.metrics_route = '/r/'
 
     try:
-        if debug:
-            times['start'] = time()
-
         try:
             lon = float(lon)
             lat = float(lat)
@@ -555,18 +1104,57 @@ def reverse_search_url(lon, lat, classes):
             data['result'] = {'message': 'Invalid latitude.'}
             return formatResponse(data, code)
 
-        if debug:
-            times['prepare'] = time() - times['start']
+        # Optional number of the nearest places
+        limit = None
+        if request.args.get('limit'):
+            try:
+                limit = int(request.args.get('limit'))
+            except ValueError:
+                limit = 0
+            if limit < 1 or limit > SEARCH_MAX_COUNT:
+                data['result'] = {'message': 'Limit must be between 1 and {}.'.format(SEARCH_MAX_COUNT)}
+                return formatResponse(data, code)
+
+        # Optional search mode, 'contains' finds the areas containing the point
+        mode = request.args.get('mode')
+        if mode not in (None, 'nearest', 'contains'):
+            data['result'] = {'message': 'Mode must be nearest or contains.'}
+            return formatResponse(data, code)
+
+        times['prepare'] = time() - times['start']
 
         code = 200
         filter_classes = []
         if classes:
             # This argument can be list separated by comma
             filter_classes = classes.encode('utf-8').split(',')
-        result, distance = reverse_search(lon, lat, filter_classes, debug)
-        data['result'] = prepareResultJson(result)
+        g.metrics_classes = filter_classes
+        g.request_inputs = {'lon': lon, 'lat': lat, 'classes': filter_classes,
+                            'limit': limit, 'mode': mode}
+        deadline = times['start'] + get_route_deadline('/r/')
+        if debug or SINGLE_FLIGHT is None:
+            code, data['result'], result, distance = reverse_search_prepared(
+                lon, lat, filter_classes, debug, deadline, limit, mode)
+        else:
+            # Coalesce identical in-flight requests, the JSON/JSONP callback is applied later
+            key = ('/r/', lon, lat, tuple(sorted(set(filter_classes))), limit, mode)
+            try:
+                (code, data['result'], result, distance), shared = SINGLE_FLIGHT.do(
+                    key,
+                    lambda: reverse_search_prepared(
+                        lon, lat, filter_classes, debug, deadline, limit, mode),
+                    deadline - time())
+            except SingleFlightTimeout:
+                METRICS.inc('websearch_deadline_exceeded_total', {'route': '/r/'})
+                code = 503
+                data['result'] = {'message': 'Request deadline exceeded, try again later.'}
+                shared = False
+            if shared:
+                METRICS.inc('websearch_coalesced_requests_total', {'route': '/r/'})
+        if code == 503:
+            return serviceUnavailableResponse(data)
+        times['process'] = time() - times['start']
         if debug:
-            times['process'] = time() - times['start']
             data['debug'] = result['debug']
             data['debug']['distance'] = distance
             data['debug_times'] = times
@@ -591,13 +1179,518 @@ def reverse_search_url_public(lon, lat, classes):
 # =============================================================================
 
 
-# Load attributes at runtime
-get_attributes_values('ind_name_exact', CHECK_ATTR_FILTER)
-pprint(ATTR_VALUES)
+# =============================================================================
+"""
+Viewport (bounding box) search support
+"""
+
+
+# viewport_zoom - zoom level, whose tile grid cell is at least as large as the viewport
+# west, south, east, north - float - the viewport, west > east for antimeridian spanning viewports
+# returns - zoom level
+def viewport_zoom(west, south, east, north):
+    span_lon = east - west
+    if span_lon <= 0:
+        span_lon += 360.0
+    span_lat = max(north - south, 1e-9)
+    zoom = int(math.floor(math.log(360.0 / max(span_lon, 2 * span_lat), 2)))
+    return max(0, min(zoom, 20))
+
+
+# snap_viewport - snap the viewport outward to the tile grid of the zoom level
+# west, south, east, north - float - the viewport, west > east for antimeridian spanning viewports
+# zoom    - int   - the zoom level
+# returns - snapped west, south, east, north tuple
+def snap_viewport(west, south, east, north, zoom):
+    grid_lon = 360.0 / 2 ** zoom
+    grid_lat = 180.0 / 2 ** zoom
+    return (
+        math.floor((west + 180.0) / grid_lon) * grid_lon - 180.0,
+        math.floor((south + 90.0) / grid_lat) * grid_lat - 90.0,
+        math.ceil((east + 180.0) / grid_lon) * grid_lon - 180.0,
+        math.ceil((north + 90.0) / grid_lat) * grid_lat - 90.0,
+    )
+
+
+# bbox_search - find the most important places inside the viewport
+# west, south, east, north - float - the viewport, west > east for antimeridian spanning viewports
+# count    - int   - the number of places
+# cursor   - tuple - (importance_rank, id) of the last place of the previous page, None for the first page
+# deadline - float - absolute time (as time()) when the search has to stop
+# returns - result with 'next_cursor', if there are more places
+def bbox_search(west, south, east, north, count, cursor, deadline):
+    result = {
+        'total_found': 0,
+        'count': 0,
+        'start_index': 0,
+        'matches': [],
+        'status': False,
+        'queries': [],
+        'next_cursor': None,
+    }
+
+    try:
+        db, dbcursor = get_db_cursor(deadline)
+    except PoolTimeout as ex:
+        result['timed_out'] = True
+        result['message'] = str(ex)
+        return result
+    except Exception as ex:
+        result['message'] = str(ex)
+        return result
+
+    # Keyset pagination by importance DESC, id ASC, without OFFSET and max_matches limit.
+    # The key is the integer importance_rank, the float importance read back as text
+    # does not compare equal to the stored value, so the ties would be skipped or repeated.
+    select = "SELECT *"
+    filter_cursor = ""
+    if cursor is not None:
+        select += (", IF(importance_rank < {0} OR (importance_rank = {0} AND id > {1}), 1, 0)"
+                   " AS after_cursor").format(int(cursor[0]), int(cursor[1]))
+        filter_cursor = " AND after_cursor = 1"
+    select += " FROM ind_name_exact WHERE "
+
+    # SphinxQL does not support the OR operator, antimeridian spanning viewport needs 2 queries
+    wherelon = []
+    if west > east:
+        wherelon.append("lon BETWEEN {} AND 180.0".format(west))
+        wherelon.append("lon BETWEEN -180.0 AND {}".format(east))
+    else:
+        wherelon.append("lon BETWEEN {} AND {}".format(west, east))
+    wherelat = "lat BETWEEN {} AND {}".format(south, north)
+    # one more place tells, whether there is next page
+    order = " ORDER BY importance_rank DESC, id ASC LIMIT {}".format(count + 1)
+    order += " OPTION max_query_time={}".format(max(1, int((deadline - time()) * 1000)))
+
+    sqls = []
+    for where in wherelon:
+        sqls.append(select + " AND ".join([where, wherelat]) + filter_cursor + order)
+    result['queries'] = sqls
+
+    db, dbcursor, (status, results_new) = query_with_failover(
+        db, dbcursor, lambda cursor: get_batch_query_result(cursor, sqls), deadline)
+    if status:
+        db.close()
+    else:
+        db.discard()
+        result['message'] = results_new[-1]['message']
+        return result
+
+    matches = []
+    for result_new in results_new:
+        matches.extend(result_new['matches'])
+    for match in matches:
+        match['attrs'].pop('after_cursor', None)
+    matches.sort(key=lambda match: (-int(match['attrs']['importance_rank']), match['id']))
+    if len(matches) > count:
+        last = matches[count - 1]
+        result['next_cursor'] = (int(last['attrs']['importance_rank']), last['id'])
+    matches = matches[:count]
+
+    result['matches'] = matches
+    result['count'] = len(matches)
+    result['total_found'] = len(matches)
+    result['status'] = True
+    return result
+
+
+# ---------------------------------------------------------
+@app.route('/bbox/<west>/<south>/<east>/<north>.js')
+def bbox_search_url(west, south, east, north):
+    """REST API for bbox_search."""
+    code = 400
+    data = {'format': 'json'}
+    times = g.timings
+    g.metrics_route = '/bbox/'
+
+    try:
+        try:
+            west, south, east, north = float(west), float(south), float(east), float(north)
+        except ValueError:
+            data['result'] = {'message': 'Bounding box coordinates must be numeric.'}
+            return formatResponse(data, code)
+
+        if not (-180.0 <= west <= 180.0 and -180.0 <= east <= 180.0):
+            data['result'] = {'message': 'Invalid longitude.'}
+            return formatResponse(data, code)
+        if not (-90.0 <= south < north <= 90.0):
+            data['result'] = {'message': 'Invalid latitude.'}
+            return formatResponse(data, code)
+
+        count = SEARCH_DEFAULT_COUNT
+        if request.args.get('count'):
+            try:
+                count = int(request.args.get('count'))
+            except ValueError:
+                count = 0
+            if count < 1 or count > SEARCH_MAX_COUNT:
+                data['result'] = {'message': 'Count must be between 1 and {}.'.format(SEARCH_MAX_COUNT)}
+                return formatResponse(data, code)
+
+        # Cursor is importance_rank and id of the last place of the previous page
+        cursor = None
+        if request.args.get('cursor'):
+            m = re.match(r'^([0-9]+)_([0-9]+)$', request.args.get('cursor'))
+            if m is None:
+                data['result'] = {'message': 'Invalid cursor.'}
+                return formatResponse(data, code)
+            cursor = (int(m.group(1)), int(m.group(2)))
+
+        # Redirect to the viewport snapped to the zoom grid, so the responses can be cached.
+        # Snapped viewport can span 2 grid cells, so it is aligned to the grid of the next zoom.
+        viewport = (west, south, east, north)
+        zoom = viewport_zoom(*viewport)
+        snapped = snap_viewport(west, south, east, north, zoom)
+        if snapped != viewport and snap_viewport(west, south, east, north, zoom + 1) != viewport \
+                and not request.args.get('nosnap'):
+            url = '/bbox/{!r}/{!r}/{!r}/{!r}.js'.format(*snapped)
+            if request.query_string:
+                url += '?' + request.query_string
+            resp = redirect(url, code=302)
+            resp.headers['Access-Control-Allow-Origin'] = '*'
+            resp.headers['Cache-Control'] = CACHE_CONTROL
+            return resp
+
+        times['prepare'] = time() - times['start']
+
+        code = 200
+        g.request_inputs = {'west': west, 'south': south, 'east': east, 'north': north,
+                            'count': count, 'cursor': cursor}
+        deadline = times['start'] + get_route_deadline('/bbox/')
+        slot = admit_request('/bbox/', deadline)
+        if slot is None:
+            data['result'] = {'message': 'Service overloaded, try again later.'}
+            return serviceUnavailableResponse(data)
+        try:
+            result = bbox_search(west, south, east, north, count, cursor, deadline)
+        finally:
+            release_request(slot)
+        g.search_queries = result['queries']
+        if result.get('timed_out'):
+            METRICS.inc('websearch_deadline_exceeded_total', {'route': '/bbox/'})
+            data['result'] = {'message': 'Request deadline exceeded, try again later.'}
+            return serviceUnavailableResponse(data)
+
+        data['result'] = prepareResultJson(result)
+        data['result'].pop('nextIndex', None)
+        data['result'].pop('previousIndex', None)
+        if result['next_cursor'] is not None:
+            data['result']['nextCursor'] = '{}_{}'.format(*result['next_cursor'])
+        times['process'] = time() - times['start']
+    except:
+        traceback.print_exc()
+        data['result'] = {'message': 'Unexpected failure to handle this request. Please, contact sysadmin.'}
+        code = 500
+
+    return formatResponse(data, code)
+
+# =============================================================================
+# End Viewport search support
+# =============================================================================
+
+
+# =============================================================================
+"""
+Autocomplete search support
+"""
+
+
+# escape_match - escape characters of the SphinxQL full text query syntax
+def escape_match(query):
+    return re.sub(r'([\\()|\-!@~"&/^$=<>\[\]*?])', r'\\\1', query)
+
+
+# prefixes_search - find the most important places with a word starting with the query in the prefixes index
+# query        - unicode - the searched text
+# country_code - string  - the country code to filter, None without filtering
+# start_index  - int     - the index of the first place
+# count        - int     - the number of places
+# returns - result, None if the query is not covered by the prefixes index
+def prefixes_search(query, country_code, start_index, count):
+    prefixes = get_memory_index('prefixes')
+    if prefixes is None or start_index + count > prefixes.top_n:
+        return None
+    ids = prefixes.lookup(query, country_code)
+    if ids is None:
+        return None
+
+    # The attributes are stored in the prefixes index, searchd is not queried at all
+    matches = prefixes.documents(ids[start_index:start_index + count])
+    return {
+        'total_found': len(ids),
+        'count': len(matches),
+        'start_index': start_index,
+        'matches': matches,
+        'status': True,
+        'queries': [],
+    }
+
+
+# search - find the most important places with a name matching the query
+# query        - unicode - the searched text
+# country_code - string  - the country code to filter, None without filtering
+# start_index  - int     - the index of the first place
+# count        - int     - the number of places
+# deadline     - float   - absolute time (as time()) when the search has to stop
+# returns - result
+def search(query, country_code, start_index, count, deadline):
+    result = {
+        'total_found': 0,
+        'count': 0,
+        'start_index': start_index,
+        'matches': [],
+        'status': False,
+        'queries': [],
+    }
+
+    try:
+        db, cursor = get_db_cursor(deadline)
+    except PoolTimeout as ex:
+        result['timed_out'] = True
+        result['message'] = str(ex)
+        return result
+    except Exception as ex:
+        result['message'] = str(ex)
+        return result
+
+    # Full text index carries only the ranking/filter attributes
+    sql = "SELECT id FROM ind_name_prefix WHERE MATCH(%s)"
+    args = [escape_match(query).encode('utf-8')]
+    if country_code:
+        sql += " AND country_code = %s"
+        args.append(country_code)
+    sql += " ORDER BY importance DESC, id ASC LIMIT {}, {}".format(start_index, count)
+    sql += " OPTION max_query_time={}".format(max(1, int((deadline - time()) * 1000)))
+    result['queries'].append(sql)
+    db, cursor, (status, result_new) = query_with_failover(
+        db, cursor, lambda cursor: get_query_result(cursor, sql, args), deadline)
+    if not status:
+        db.discard()
+        result['message'] = result_new['message']
+        return result
+    result['total_found'] = result_new['total_found']
+    ids = [match['id'] for match in result_new['matches']]
+    if not ids:
+        db.close()
+        result['status'] = True
+        return result
+
+    # All attributes are fetched from the attribute store
+    db, cursor, (status, result_new, sql) = query_with_failover(
+        db, cursor, lambda cursor: get_attributes_by_id(cursor, ids, deadline), deadline)
+    result['queries'].append(sql)
+    if status:
+        db.close()
+    else:
+        db.discard()
+        result['message'] = result_new['message']
+        return result
+
+    result['matches'] = result_new['matches']
+    result['count'] = len(result['matches'])
+    result['status'] = True
+    return result
+
+
+# ---------------------------------------------------------
+@app.route('/q/<query>.js', defaults={'country_code': None})
+@app.route('/<country_code>/q/<query>.js')
+def search_url(query, country_code):
+    """REST API for search."""
+    code = 400
+    data = {'format': 'json'}
+    times = g.timings
+    g.metrics_route = '/q/'
+
+    try:
+        query = query.strip()
+        if not query:
+            data['result'] = {'message': 'Empty query.'}
+            return formatResponse(data, code)
+
+        if country_code:
+            country_code = country_code.encode('utf-8').lower()
+            if 'country_code' in ATTR_VALUES and country_code not in ATTR_VALUES['country_code']:
+                data['result'] = {'message': 'Invalid country code.'}
+                return formatResponse(data, code)
+
+        try:
+            start_index = int(request.args.get('startIndex', 0))
+            count = int(request.args.get('count', SEARCH_DEFAULT_COUNT))
+        except ValueError:
+            start_index = count = -1
+        if start_index < 0 or count < 1 or count > SEARCH_MAX_COUNT:
+            data['result'] = {'message': 'Count must be between 1 and {}.'.format(SEARCH_MAX_COUNT)}
+            return formatResponse(data, code)
+
+        times['prepare'] = time() - times['start']
+
+        code = 200
+        g.request_inputs = {'query': query, 'country_code': country_code,
+                            'start_index': start_index, 'count': count}
+        # The shortest queries are answered by the prefixes index, without admission to searchd
+        result = prefixes_search(query, country_code, start_index, count)
+        if result is not None:
+            METRICS.inc('websearch_prefixes_index_hits_total', {'route': '/q/'})
+        else:
+            deadline = times['start'] + get_route_deadline('/q/')
+            slot = admit_request('/q/', deadline)
+            if slot is None:
+                data['result'] = {'message': 'Service overloaded, try again later.'}
+                return serviceUnavailableResponse(data)
+            try:
+                result = search(query, country_code, start_index, count, deadline)
+            finally:
+                release_request(slot)
+            if result.get('timed_out'):
+                METRICS.inc('websearch_deadline_exceeded_total', {'route': '/q/'})
+                data['result'] = {'message': 'Request deadline exceeded, try again later.'}
+                return serviceUnavailableResponse(data)
+        g.search_queries = result['queries']
+
+        data['result'] = prepareResultJson(result)
+        times['process'] = time() - times['start']
+    except:
+        traceback.print_exc()
+        data['result'] = {'message': 'Unexpected failure to handle this request. Please, contact sysadmin.'}
+        code = 500
+
+    return formatResponse(data, code)
+
+# =============================================================================
+# End Autocomplete search support
+# =============================================================================
+
+
+# ---------------------------------------------------------
+def metrics_class_label(classes):
+    """Class filter label with bounded cardinality, unknown classes are 'other'."""
+    if not classes:
+        return 'all'
+    known = ATTR_VALUES.get('class', [])
+    return ','.join(sorted(set(cl if cl in known else 'other' for cl in classes)))
+
+
+@app.before_request
+def start_request_timings():
+    g.timings = {'start': time()}
+    g.profiler = None
+    if PROFILE_SAMPLE_RATE > 0 and request.endpoint != 'metrics_url' and \
+            random.randint(1, PROFILE_SAMPLE_RATE) == 1 and PROFILER_LOCK.acquire(False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.teardown_request
+def stop_request_profiler(exc):
+    """Dump call stats of the sampled request into PROFILE_DIR."""
+    profiler = getattr(g, 'profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    g.profiler = None
+    PROFILER_LOCK.release()
+    try:
+        if not path.isdir(PROFILE_DIR):
+            makedirs(PROFILE_DIR)
+        filename = '{}-{}-{}.prof'.format(
+            datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f'), getpid(), request.endpoint)
+        profiler.dump_stats(path.join(PROFILE_DIR, filename))
+    except (IOError, OSError) as ex:
+        print(str(ex))
+
+
+def log_slow_request(labels, code, duration):
+    """Write inputs, SphinxQL queries and timings of the slow request."""
+    METRICS.inc('websearch_slow_requests_total', labels)
+    search = getattr(g, 'search_timings', None) or {}
+    entry = {
+        'time': datetime.utcnow().isoformat() + 'Z',
+        'pid': getpid(),
+        'route': labels['route'],
+        'url': request.full_path,
+        'inputs': getattr(g, 'request_inputs', None),
+        'code': code,
+        'duration': duration,
+        'iterations': search.get('iterations'),
+        'timings': dict((k, v) for k, v in g.timings.items() if k != 'start'),
+        'search_timings': search,
+        'queries': getattr(g, 'search_queries', []),
+    }
+    get_slow_logger().info(dumps(entry))
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Record timings of the handled request into the metrics."""
+    route = getattr(g, 'metrics_route', None)
+    if route is None:
+        return response
+    try:
+        labels = {
+            'route': route,
+            'class': metrics_class_label(getattr(g, 'metrics_classes', None)),
+        }
+        duration = time() - g.timings['start']
+        METRICS.inc('websearch_requests_total',
+                    dict(labels, code=str(response.status_code)))
+        METRICS.observe('websearch_request_duration_seconds', duration, labels)
+        if SLOW_REQUEST_THRESHOLD > 0 and duration >= SLOW_REQUEST_THRESHOLD:
+            log_slow_request(labels, response.status_code, duration)
+        if 'serialize' in g.timings:
+            METRICS.observe('websearch_stage_duration_seconds', g.timings['serialize'],
+                            dict(labels, stage='serialize'))
+        search = getattr(g, 'search_timings', None)
+        if search:
+            METRICS.observe('websearch_stage_duration_seconds', search['connect'],
+                            dict(labels, stage='connect'))
+            METRICS.observe('websearch_stage_duration_seconds', sum(search['queries']),
+                            dict(labels, stage='query'))
+            METRICS.observe('websearch_stage_duration_seconds', search['merge'],
+                            dict(labels, stage='merge'))
+            for duration in search['queries']:
+                METRICS.observe('websearch_sphinxql_query_duration_seconds', duration, labels)
+            METRICS.inc('websearch_sphinxql_queries_total', labels, len(search['queries']))
+            METRICS.observe('websearch_bbox_iterations', search['iterations'], labels)
+        for endpoint in DB_POOL.status():
+            METRICS.set('websearch_sphinxql_endpoint_in_flight', endpoint['in_flight'],
+                        {'endpoint': endpoint['endpoint']})
+            METRICS.set('websearch_sphinxql_endpoint_up', int(endpoint['up']),
+                        {'endpoint': endpoint['endpoint']})
+        METRICS.flush()
+    except:
+        traceback.print_exc()
+    return response
+
+
+@app.route('/metrics')
+def metrics_url():
+    """Prometheus metrics of all worker processes."""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app():
+    """Load the runtime data of the routes, called only by the servers of the app."""
+    # Load attributes at runtime
+    get_attributes_values('ind_name_exact', CHECK_ATTR_FILTER)
+    pprint(ATTR_VALUES)
+    # Load in-memory indexes before the workers are forked
+    for name in MEMORY_INDEXES:
+        get_memory_index(name)
+
+
+# uwsgi loads this file as the app, the tools importing the search functions
+# (reverse_bulk.py, tests) do not query searchd nor load the indexes at import
+try:
+    import uwsgi  # noqa
+    init_app()
+except ImportError:
+    pass
 
 
 """
 Main launcher
 """
 if __name__ == '__main__':
+    init_app()
     app.run(threaded=False, host='0.0.0.0', port=8000)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Cooperative (gevent) serving mode of WebSearch gate for OSMNames-SphinxSearch
+#
+# One process multiplexes many in-flight requests over a shared pool of
+# SphinxQL connections. The pure-python PyMySQL client is used instead of
+# MySQLdb, so the socket I/O yields to other greenlets.
+# Routes and JSON/JSONP output are the same as of websearch.py.
+
+from gevent import monkey
+monkey.patch_all()
+
+import pymysql
+pymysql.install_as_MySQLdb()
+
+from os import environ, getenv
+
+# Shared connection pool of the whole process, keep below searchd max_children
+environ.setdefault('DB_POOL_SIZE', '24')
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from admission import AdmissionControl, LocalSemaphore
+from singleflight import SingleFlight
+import websearch
+
+app = websearch.app
+
+# Greenlets of this process share its SphinxQL connections, admit as many
+# as the pool holds and queue at most twice as many
+ADMISSION_MAX_CONCURRENT = int(getenv('ADMISSION_MAX_CONCURRENT', environ['DB_POOL_SIZE']))
+ADMISSION_MAX_QUEUE = int(getenv('ADMISSION_MAX_QUEUE', 2 * ADMISSION_MAX_CONCURRENT))
+websearch.ADMISSION = AdmissionControl(max_concurrent=ADMISSION_MAX_CONCURRENT, max_queue=ADMISSION_MAX_QUEUE,
+                                       semaphore=LocalSemaphore(ADMISSION_MAX_CONCURRENT))
+
+# Identical concurrent reverse requests of the greenlets share one response
+websearch.SINGLE_FLIGHT = SingleFlight()
+
+# The profiler of sampled requests hooks the thread shared by all greenlets,
+# the concurrent requests would be mixed into one profile
+websearch.PROFILE_SAMPLE_RATE = 0
+
+# Attribute values of the filters and the in-memory indexes
+websearch.init_app()
+
+# Maximum number of concurrently handled requests
+GEVENT_MAX_CONNECTIONS = 500
+if getenv('GEVENT_MAX_CONNECTIONS'):
+    GEVENT_MAX_CONNECTIONS = int(getenv('GEVENT_MAX_CONNECTIONS'))
+
+WEBSEARCH_GEVENT_LISTEN = '127.0.0.1:9001'
+if getenv('WEBSEARCH_GEVENT_LISTEN'):
+    WEBSEARCH_GEVENT_LISTEN = getenv('WEBSEARCH_GEVENT_LISTEN')
+
+
+"""
+Main launcher
+"""
+if __name__ == '__main__':
+    host, port = WEBSEARCH_GEVENT_LISTEN.rsplit(':', 1)
+    server = WSGIServer((host, int(port)), app, spawn=Pool(GEVENT_MAX_CONNECTIONS), log=None)
+    server.serve_forever()